@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Best-improvement vs first-improvement (--climb) on evaluations to
+convergence and final log likelihood. For example
+
+    python benchmarks/climb.py -s /path/to/10C-1k/replicate_*/sequence_TRUE.phy -o climb.jsonl
+
+By default every search starts from a random tree and runs with
+fake_baseml.py. When a replicate has a model_tree next to its alignment
+(as the simulated 10C-1k replicates do), that tree becomes
+FAKE_BASEML_TRUE_TREE, so the likelihood surface has a real optimum to
+climb to. 'stochastic' runs once per seed, the other modes only depend on
+the starting tree (which comes from the first seed for them).
+
+Every run is appended to the output as one JSON object per line.
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+SRC = Path(__file__).resolve().parent.parent
+
+def run_search(args, seq_path, climb, seed):
+    with tempfile.TemporaryDirectory() as output:
+        proc_args = [
+            sys.executable, str(SRC / "nhts.py"),
+            "-t", str(args.template.absolute()),
+            "-s", str(seq_path.absolute()),
+            "-o", f"{output}/search",
+            "-M", str(args.max_iter),
+            "-B", args.baseml,
+            "-S", args.start,
+            "-z", str(seed),
+            "-j", str(args.jobs),
+            "--climb", climb,
+            "-l", "WARNING"
+        ]
+        if args.processes > 1:
+            proc_args.extend(["-P", str(args.processes), "-X", "3"])
+        env = dict(os.environ, FAKE_BASEML_LATENCY=args.latency)
+        true_tree = seq_path.parent / args.true_tree
+        if true_tree.is_file():
+            env["FAKE_BASEML_TRUE_TREE"] = true_tree.read_text().strip()
+        tic = time.perf_counter()
+        proc = subprocess.run(proc_args, cwd=SRC, env=env, capture_output=True, text=True)
+        seconds = time.perf_counter() - tic
+    likelihoods = re.findall(r"^\d+:\s+(-[\d.]+)", proc.stdout, flags=re.MULTILINE)
+    evaluated = re.search(r"^evaluated (\d+) trees", proc.stdout, flags=re.MULTILINE)
+    return {
+        "alignment" : str(seq_path),
+        "climb" : climb,
+        "seed" : seed,
+        "processes" : args.processes,
+        "latency" : args.latency,
+        "seconds" : seconds,
+        "evaluations" : int(evaluated.group(1)) if evaluated else None,
+        "log likelihood" : float(likelihoods[-1]) if likelihoods else None,
+        "returncode" : proc.returncode
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Best vs first improvement hill climbing benchmark")
+    parser.add_argument("-s", "--seq", type=Path, nargs="+", required=True, help="PHYLIP alignments")
+    parser.add_argument("-t", "--template", type=Path, default=SRC / "tests/files/hky_template.ctl")
+    parser.add_argument("-B", "--baseml", default=str(SRC / "benchmarks/fake_baseml.py"))
+    parser.add_argument("-L", "--latency", default="fixed:0", help="FAKE_BASEML_LATENCY for every run")
+    parser.add_argument("-T", "--true_tree", default="model_tree", help="file next to each alignment to use as FAKE_BASEML_TRUE_TREE")
+    parser.add_argument("-S", "--start", default="random", help="starting tree strategy")
+    parser.add_argument("-C", "--climbs", nargs="+", default=["best", "first", "stochastic"])
+    parser.add_argument("-z", "--seeds", type=int, nargs="+", default=[1, 2, 3])
+    parser.add_argument("-P", "--processes", type=int, default=1, help="more than 1 runs strategy 3 under MPI")
+    parser.add_argument("-M", "--max_iter", type=int, default=100)
+    parser.add_argument("-j", "--jobs", type=int, default=1)
+    parser.add_argument("-o", "--output", type=Path, default=Path("climb.jsonl"))
+    args = parser.parse_args()
+
+    print(f"{'alignment':<50} {'climb':<11} {'seed':>4} {'evals':>6} {'lnL':>14} {'seconds':>8}", flush=True)
+    with open(args.output, 'a') as fo:
+        for seq_path in args.seq:
+            for climb in args.climbs:
+                for seed in (args.seeds if climb == "stochastic" else args.seeds[:1]):
+                    result = run_search(args, seq_path, climb, seed)
+                    fo.write(json.dumps(result) + "\n")
+                    fo.flush()
+                    if result["returncode"] != 0:
+                        print(f"{str(seq_path)[-50:]:<50} {climb:<11} {seed:>4} failed", flush=True)
+                        continue
+                    print(f"{str(seq_path)[-50:]:<50} {climb:<11} {seed:>4} {result['evaluations']:>6} {result['log likelihood']:>14.6f} {result['seconds']:>8.1f}", flush=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+Stand-in for PAML's baseml, for benchmarking and testing the search drivers
+on machines without PAML (or without the patience). Use it with
+
+    nhts.py -B benchmarks/fake_baseml.py ...
+
+Like baseml it reads the control file given on the command line (from the
+working directory), but instead of optimizing anything it sleeps for a
+while and writes a RESULT file with a made-up likelihood that
+parse_baseml_result can read. The likelihood only depends on the alignment
+and the labelled tree (not on how the tree is written down), so repeated
+runs give the same search.
+
+Environment variables:
+    FAKE_BASEML_LATENCY     "fixed:S", "uniform:A,B" or "lognormal:MU,SIGMA"
+                            (seconds, lognormal is exp(N(MU, SIGMA))).
+                            Default fixed:0
+    FAKE_BASEML_TRUE_TREE   newick of a "true" tree. If given, every split
+                            a tree is missing from it costs 10 log-likelihood
+                            units, so searches actually climb somewhere
+    FAKE_BASEML_SCREEN_NOISE
+                            with fix_blength = 2 in the control file (branch
+                            lengths fixed, the cheap screening runs), the
+                            likelihood is made worse by |N(0, this)| and the
+                            run takes a fifth of the time. Default 5
+    FAKE_BASEML_STARTUP     seconds every process waits before the first
+                            tree, like baseml reading its inputs. Default 0
+
+Several trees in the treefile get a section each in RESULT, like baseml,
+written as it goes so a killed run leaves the finished ones behind.
+A kappa in the control file (which is what a retry after --run_timeout
+changes) gets the run a different latency, but the same likelihood.
+
+Only the standard library is used so startup stays cheap.
+"""
+import hashlib
+import os
+import random
+import re
+import sys
+import time
+from pathlib import Path
+
+TOKEN = re.compile(r"[(),;]|[^(),;:\s]+|:[^(),;]+")
+
+def parse_newick(newick):
+    # nested (name, children) tuples, branch lengths dropped
+    tokens = [t for t in TOKEN.findall(newick) if not t.startswith(':')]
+    position = 0
+    def parse_node():
+        nonlocal position
+        children = []
+        if tokens[position] == '(':
+            position += 1
+            children.append(parse_node())
+            while tokens[position] == ',':
+                position += 1
+                children.append(parse_node())
+            position += 1 # ')'
+        name = ''
+        if position < len(tokens) and tokens[position] not in '(),;':
+            name = tokens[position]
+            position += 1
+        return (name, children)
+    return parse_node()
+
+def labelled_splits(tree):
+    """
+    (split, model label) for every branch, plus the root's label. A split is
+    the sorted tuple of leaf names on the side without the first leaf
+    """
+    branches = []
+    def leaves_below(node, is_root):
+        name, children = node
+        if children:
+            leaves = frozenset().union(*(leaves_below(child, False) for child in children))
+        else:
+            leaves = frozenset({name.split('#')[0]})
+        if not is_root:
+            branches.append((leaves, name.partition('#')[2]))
+        return leaves
+    all_leaves = leaves_below(tree, True)
+    first = min(all_leaves)
+    canonical = []
+    for leaves, label in branches:
+        side = all_leaves - leaves if first in leaves else leaves
+        canonical.append((tuple(sorted(side)), label))
+    return sorted(canonical), tree[0].partition('#')[2], all_leaves
+
+def tree_key(tree):
+    branches, root_label, _ = labelled_splits(tree)
+    renumber = {}
+    for label in [root_label] + [label for _, label in branches]:
+        renumber.setdefault(label, str(len(renumber) + 1))
+    return repr(([(split, renumber[label]) for split, label in branches], renumber[root_label]))
+
+def nontrivial_splits(tree):
+    branches, _, all_leaves = labelled_splits(tree)
+    return {split for split, _ in branches if 1 < len(split) < len(all_leaves) - 1}
+
+def write_plain(tree, rng):
+    name, children = tree
+    if not children:
+        return f"{name.split('#')[0]}: {rng.uniform(0.01, 0.3):.6f}"
+    return "(" + ", ".join(write_plain(child, rng) for child in children) + f"): {rng.uniform(0.01, 0.3):.6f}"
+
+def nodes_in_order(tree):
+    # leaves first, then internal nodes, like baseml numbers them
+    leaves, internal = [], []
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        (internal if node[1] else leaves).append(node)
+        stack.extend(reversed(node[1]))
+    return leaves + internal
+
+def sample_latency(spec, rng):
+    kind, _, values = spec.partition(':')
+    values = [float(x) for x in values.split(',')] if values else []
+    if kind == 'fixed':
+        return values[0]
+    elif kind == 'uniform':
+        return rng.uniform(values[0], values[1])
+    elif kind == 'lognormal':
+        return rng.lognormvariate(values[0], values[1])
+    raise ValueError(f"unknown latency distribution {spec}")
+
+def read_control(control_path):
+    settings = {}
+    with open(control_path, 'r') as fi:
+        for line in fi:
+            key, eq, value = line.split('*')[0].partition('=')
+            if eq:
+                settings[key.strip()] = value.strip()
+    return settings
+
+def fake_result(fo, number, newick, control, alignment_hash):
+    tree = parse_newick(newick)
+    digest = hashlib.sha256(f"{alignment_hash} {tree_key(tree)}".encode()).digest()
+    rng = random.Random(digest)
+    log_likelihood = -1000 - 50 * rng.random()
+    true_tree = os.environ.get("FAKE_BASEML_TRUE_TREE")
+    if true_tree:
+        missing = nontrivial_splits(parse_newick(true_tree)) - nontrivial_splits(tree)
+        log_likelihood -= 10 * len(missing)
+
+    # a different starting point takes a different amount of time
+    latency_rng = random.Random(f"{digest.hex()} {control['kappa']}") if "kappa" in control else rng
+    latency = sample_latency(os.environ.get("FAKE_BASEML_LATENCY", "fixed:0"), latency_rng)
+    if control.get("fix_blength") == "2":
+        log_likelihood -= abs(rng.gauss(0, float(os.environ.get("FAKE_BASEML_SCREEN_NOISE", "5"))))
+        latency /= 5
+
+    # baseml writes the tree's line when it starts on it, and the rest
+    # once it's done
+    print(f"fake baseml: {newick}")
+    fo.write(f"TREE # {number:2d}:  {newick}\n")
+    fo.flush()
+    time.sleep(latency)
+
+    nodes = nodes_in_order(tree)
+    lines = [
+        f"lnL(ntime: {len(nodes) - 1}  np: {len(nodes) + 4}):  {log_likelihood:.6f}      +0.000000",
+        "",
+        write_plain(tree, rng).rsplit(':', 1)[0] + ";",
+        ""
+    ]
+    for number, (name, _) in enumerate(nodes, start=1):
+        label = name.split('#')[0] or f"node{number}"
+        lines.append(f"Node #{number}  {label}  (blength = {rng.uniform(0.01, 0.3):.6f})")
+        lines.append(f"rates {rng.uniform(1, 5):.5f}")
+        lines.append("")
+        lines.append("base frequencies (TCAG) " + " ".join(f"{x:.5f}" for x in [0.25] * 4))
+    print(f"lnL = {log_likelihood:.6f}")
+    fo.write("\n".join(lines) + "\n\n")
+    fo.flush()
+
+def main():
+    control = read_control(sys.argv[1] if len(sys.argv) > 1 else "baseml.ctl")
+    with open(control["treefile"], 'r') as fi:
+        header, *newicks = fi.read().splitlines()
+    n_trees = int(header.split()[1])
+    with open(control["seqfile"], 'rb') as fi:
+        alignment_hash = hashlib.sha256(fi.read()).hexdigest()
+    time.sleep(float(os.environ.get("FAKE_BASEML_STARTUP", "0")))
+
+    with open(control["outfile"], 'w') as fo:
+        for number, newick in enumerate(newicks[:n_trees], start=1):
+            fake_result(fo, number, newick.strip(), control, alignment_hash)
+
+if __name__ == "__main__":
+    main()
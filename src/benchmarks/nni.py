@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Times building an NNI neighborhood plus the keys used for dedupe, the old
+way (Biopython round trip, then topology_key on every neighbor) against
+nni_moves/nni_tree, on random unrooted trees.
+
+    python benchmarks/nni.py -n 10 100 1000
+"""
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+import ete3
+import treesearch as ts
+
+def biopython_neighborhood(tree, index):
+    return [(ts.topology_key(t, index), t) for t in ts.biopython_nearest_neighbors(tree)]
+
+def native_neighborhood(tree, index):
+    return [(key, ts.nni_tree(tree, move)) for key, move in ts.nni_moves(tree, index)]
+
+def native_keys_only(tree, index):
+    # what dedupe costs when every neighbor has been visited already
+    return [key for key, _ in ts.nni_moves(tree, index)]
+
+def random_unrooted(n_taxa):
+    tree = ete3.Tree()
+    tree.populate(n_taxa, names_library=[f"t{i}" for i in range(n_taxa)])
+    tree.unroot()
+    return tree
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark NNI neighborhood generation")
+    parser.add_argument("-n", "--taxa", type=int, nargs="+", default=[10, 50, 100, 500, 1000])
+    parser.add_argument("-r", "--repeat", type=int, default=3)
+    parser.add_argument("-z", "--seed", type=int, default=0)
+    args = parser.parse_args()
+    random.seed(args.seed)
+    sys.setrecursionlimit(10000) # Biopython and ete3 newick handling recurse
+
+    methods = [
+        ("biopython", biopython_neighborhood),
+        ("native", native_neighborhood),
+        ("native keys only", native_keys_only)
+    ]
+    print(f"{'taxa':>6} {'neighbors':>10} " + " ".join(f"{name:>18}" for name, _ in methods))
+    for n_taxa in args.taxa:
+        tree = random_unrooted(n_taxa)
+        index = ts.taxon_index(tree)
+        old_keys = {key for key, _ in biopython_neighborhood(tree, index)}
+        new_keys = set(native_keys_only(tree, index))
+        if old_keys != new_keys:
+            print(f"neighborhoods differ for {n_taxa} taxa")
+            exit(1)
+        timings = []
+        for _, method in methods:
+            tic = time.perf_counter()
+            for _ in range(args.repeat):
+                method(tree, index)
+            timings.append((time.perf_counter() - tic) / args.repeat)
+        print(f"{n_taxa:>6} {len(new_keys):>10} " + " ".join(f"{t:>17.4f}s" for t in timings), flush=True)
+
+if __name__ == "__main__":
+    main()
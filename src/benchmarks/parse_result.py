@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Times the RESULT parsers against each other. Point it at the RESULT files
+left behind by a run (e.g. with cleanup turned off, on 10C-1k):
+
+    python benchmarks/parse_result.py out/step_*/single_shift_*/RESULT
+
+"legacy" is the old read-everything / scan-backwards parser, kept here so
+there's something to compare against.
+"""
+import argparse
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+import ete3
+from utils import baseml
+from utils._helpers import read_all_lines, find_lines, first_instance_before_line
+
+def legacy_parse_baseml_result(result_path):
+    lines = read_all_lines(result_path)
+    node_parameter_lines = find_lines(lines, baseml.NODE_LINE, condition=lambda rgx, line : rgx.match(line) is not None)
+    if not node_parameter_lines:
+        return []
+    all_tree_parameters = []
+    last_node_number = 0
+    lnL_line = first_instance_before_line(lines, node_parameter_lines[0], 'lnL')
+    tree_line = first_instance_before_line(lines, node_parameter_lines[0], ';')
+    tree_parameters = {'tree' : ete3.Tree(lines[tree_line].strip()), 'log likelihood' : baseml.parse_lnL(lines[lnL_line])}
+    for npl in node_parameter_lines:
+        node_number = int(lines[npl].split("#")[1].strip().split()[0])
+        node_label = lines[npl].split()[1]
+        if node_label == '(blength':
+            node_label = None
+        node_parameters = {
+            'node label' : node_label,
+            'node #' : node_number,
+            'substitution rates' : baseml.parse_sub_rates(lines[npl+1]),
+            'base frequencies' : baseml.parse_base_freqs(lines[npl+3])
+        }
+        if last_node_number > node_number:
+            all_tree_parameters.append(tree_parameters)
+            tree_line = first_instance_before_line(lines, npl, ';')
+            lnL_line = first_instance_before_line(lines, npl, 'lnL')
+            tree_parameters = {'tree' : ete3.Tree(lines[tree_line].strip()), 'log likelihood' : baseml.parse_lnL(lines[lnL_line])}
+        tree_parameters[node_number] = node_parameters
+        last_node_number = node_number
+    all_tree_parameters.append(tree_parameters)
+    return all_tree_parameters
+
+def legacy_best(result_path):
+    return max(legacy_parse_baseml_result(result_path), key=lambda x : x['log likelihood'], default=None)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark baseml RESULT parsing")
+    parser.add_argument("results", type=Path, nargs="+", help="RESULT files")
+    parser.add_argument("-n", "--repeat", type=int, default=5, help="Times to parse every file")
+    args = parser.parse_args()
+
+    for path in args.results:
+        old = legacy_best(path)
+        new = baseml.best_baseml_result(path)
+        if old is not None and old['log likelihood'] != new['log likelihood']:
+            print(f"mismatch in {path}: {old['log likelihood']} vs {new['log likelihood']}")
+            exit(1)
+
+    parsers = [
+        ("legacy, all trees", lambda p : legacy_parse_baseml_result(p)),
+        ("streaming, all trees", lambda p : baseml.parse_baseml_result(p)),
+        ("legacy, best tree", legacy_best),
+        ("streaming, best tree", baseml.best_baseml_result),
+        ("streaming, lnL only", lambda p : list(baseml.baseml_log_likelihoods(p))),
+    ]
+    print(f"{len(args.results)} files x {args.repeat}")
+    for name, parse in parsers:
+        seconds = timeit.timeit(lambda : [parse(p) for p in args.results], number=args.repeat)
+        per_file = 1e6 * seconds / (args.repeat * len(args.results))
+        print(f"{name:<22} {seconds:8.3f}s total {per_file:10.1f}us/file")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Reproduces the serial / 2 / 4 / 8 process scaling tables from
+cmse822-deliverables/results.csv for every search strategy, using
+fake_baseml.py (or a real baseml with --baseml baseml). For example
+
+    python benchmarks/scaling.py -s /path/to/10C-1k/replicate_*/sequence_TRUE.phy \
+        --latency lognormal:-1,0.5 -o scaling.jsonl
+
+Every run is appended to the output as one JSON object per line, so runs
+from before and after a change can be compared.
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+SRC = Path(__file__).resolve().parent.parent
+
+def n_taxa(seq_path):
+    with open(seq_path, 'r') as fi:
+        return int(fi.readline().split()[0])
+
+def run_search(args, seq_path, procs, strategy):
+    with tempfile.TemporaryDirectory() as output:
+        proc_args = [
+            sys.executable, str(SRC / "nhts.py"),
+            "-t", str(args.template.absolute()),
+            "-s", str(seq_path.absolute()),
+            "-o", f"{output}/search",
+            "-M", str(args.max_iter),
+            "-B", args.baseml,
+            "-P", str(procs),
+            "-X", strategy,
+            "-j", str(args.jobs),
+            "-l", "WARNING"
+        ]
+        env = dict(os.environ, FAKE_BASEML_LATENCY=args.latency)
+        tic = time.perf_counter()
+        proc = subprocess.run(proc_args, cwd=SRC, env=env, capture_output=True, text=True)
+        seconds = time.perf_counter() - tic
+    likelihoods = re.findall(r"^\d+:\s+(-[\d.]+)", proc.stdout, flags=re.MULTILINE)
+    return {
+        "alignment" : str(seq_path),
+        "taxa" : n_taxa(seq_path),
+        "processes" : procs,
+        "strategy" : "serial" if procs == 1 else strategy,
+        "latency" : args.latency,
+        "seconds" : seconds,
+        "log likelihood" : float(likelihoods[-1]) if likelihoods else None,
+        "returncode" : proc.returncode
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Serial/MPI scaling benchmark for the tree search")
+    parser.add_argument("-s", "--seq", type=Path, nargs="+", required=True, help="PHYLIP alignments")
+    parser.add_argument("-t", "--template", type=Path, default=SRC / "tests/files/hky_template.ctl")
+    parser.add_argument("-B", "--baseml", default=str(SRC / "benchmarks/fake_baseml.py"))
+    parser.add_argument("-L", "--latency", default="lognormal:-1,0.5", help="FAKE_BASEML_LATENCY for every run")
+    parser.add_argument("-P", "--processes", type=int, nargs="+", default=[2, 4, 8])
+    parser.add_argument("-X", "--strategies", nargs="+", default=["1", "2", "3"])
+    parser.add_argument("-M", "--max_iter", type=int, default=2)
+    parser.add_argument("-j", "--jobs", type=int, default=1)
+    parser.add_argument("-o", "--output", type=Path, default=Path("scaling.jsonl"))
+    args = parser.parse_args()
+
+    configs = [(1, "1")] + [(procs, strategy) for strategy in args.strategies for procs in args.processes]
+    header = ["Taxa", "Serial"] + [f"X{strategy} {procs}p" for procs, strategy in configs[1:]]
+    print(",".join(header), flush=True)
+    with open(args.output, 'a') as fo:
+        for seq_path in args.seq:
+            row = [str(n_taxa(seq_path))]
+            for procs, strategy in configs:
+                result = run_search(args, seq_path, procs, strategy)
+                fo.write(json.dumps(result) + "\n")
+                fo.flush()
+                row.append(f"{result['seconds']:.1f}s" if result["returncode"] == 0 else "failed")
+            print(",".join(row), flush=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+How far the screened single-shift optimum (--screen / --screen_margin) is
+from the exhaustive one. For the NJ tree of each alignment and some of its
+NNI neighbors, runs run_single_shift_baseml once exhaustively and once per
+screening setting, then prints the likelihood gap, how many placements
+were fully optimized and the time taken. For example
+
+    python benchmarks/screen.py -s /path/to/10C-1k/replicate_*/sequence_TRUE.phy -k 1 3 -m 0 2
+
+Uses fake_baseml.py unless given --baseml; with the fake, screening
+scores are the exact likelihood plus FAKE_BASEML_SCREEN_NOISE noise.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+SRC = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(SRC))
+import treesearch as ts
+from nhts import valid_executable
+
+def evaluate(tree, ctl_template, jobs, screen, margin):
+    with tempfile.TemporaryDirectory() as output:
+        output = Path(output)
+        tic = time.perf_counter()
+        # no workspace and cleanup="keep", so every fully optimized placement
+        # stays in output to be counted
+        result = ts.run_single_shift_baseml(tree, output, ctl_template, cleanup="keep", jobs=jobs, workspace=None, screen=screen, screen_margin=margin)
+        seconds = time.perf_counter() - tic
+        n_full = len(list(output.glob("single_shift_*")))
+    return result["log likelihood"], n_full, seconds
+
+def main():
+    parser = argparse.ArgumentParser(description="Screen-then-refine vs exhaustive single-shift evaluation")
+    parser.add_argument("-s", "--seq", type=Path, nargs="+", required=True, help="PHYLIP alignments")
+    parser.add_argument("-t", "--template", type=Path, default=SRC / "tests/files/hky_template.ctl")
+    parser.add_argument("-B", "--baseml", type=valid_executable, default=str(SRC / "benchmarks/fake_baseml.py"))
+    parser.add_argument("-k", "--top_k", type=int, nargs="+", default=[1, 3, 5])
+    parser.add_argument("-m", "--margins", type=float, nargs="+", default=[0.0])
+    parser.add_argument("-n", "--trees", type=int, default=4, help="NJ tree plus this many of its neighbors")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count())
+    parser.add_argument("-o", "--output", type=Path, default=Path("screen.jsonl"))
+    args = parser.parse_args()
+    ts.BASEML_EXECUTABLE = args.baseml
+
+    print(f"{'alignment':<40} {'tree':>4} {'k':>3} {'margin':>6} {'full runs':>9} {'lnL gap':>9} {'seconds':>8}", flush=True)
+    with open(args.output, 'a') as fo:
+        for seq_path in args.seq:
+            with open(args.template, 'r') as fi:
+                ctl_template = fi.read().replace("#SEQFILE", str(seq_path.absolute()))
+            alignment = ts.AlignIO.read(seq_path, "phylip-relaxed")
+            start = ts.nj_tree(alignment)
+            trees = [start] + ts.nearest_neighbors(start)[:args.trees]
+            for tree_num, tree in enumerate(trees):
+                exact, n_all, exact_seconds = evaluate(tree, ctl_template, args.jobs, 0, 0.0)
+                row = {"alignment" : str(seq_path), "tree" : tree_num, "top k" : 0, "margin" : 0.0,
+                    "log likelihood" : exact, "full runs" : n_all, "gap" : 0.0, "seconds" : exact_seconds}
+                fo.write(json.dumps(row) + "\n")
+                print(f"{str(seq_path)[-40:]:<40} {tree_num:>4} {'all':>3} {'':>6} {n_all:>9} {0:>9.3f} {exact_seconds:>8.2f}", flush=True)
+                for top_k in args.top_k:
+                    for margin in args.margins:
+                        screened, n_full, seconds = evaluate(tree, ctl_template, args.jobs, top_k, margin)
+                        row = {"alignment" : str(seq_path), "tree" : tree_num, "top k" : top_k, "margin" : margin,
+                            "log likelihood" : screened, "full runs" : n_full, "gap" : exact - screened, "seconds" : seconds}
+                        fo.write(json.dumps(row) + "\n")
+                        print(f"{str(seq_path)[-40:]:<40} {tree_num:>4} {top_k:>3} {margin:>6.1f} {n_full:>9} {exact - screened:>9.3f} {seconds:>8.2f}", flush=True)
+
+if __name__ == "__main__":
+    main()
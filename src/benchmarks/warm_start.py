@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Cold vs warm-started (--warm_start) neighbor evaluations. For each
+alignment the NJ tree is fitted once, then NNI neighbors of the fitted
+tree (which carry its branch lengths) are evaluated from scratch and
+from those branch lengths. Prints the time spent in baseml and the
+log likelihood difference (warm - cold, should not be negative). For example
+
+    python benchmarks/warm_start.py -B baseml -s /path/to/10C-1k/replicate_*/sequence_TRUE.phy
+
+Only a real baseml makes this meaningful; fake_baseml.py ignores the
+branch lengths and takes as long either way.
+"""
+import argparse
+import json
+import sys
+import tempfile
+from pathlib import Path
+
+SRC = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(SRC))
+import treesearch as ts
+from nhts import valid_executable
+from utils import trace
+
+def evaluate(tree, ctl_template, jobs, warm_start):
+    trace.tracer.totals = {}
+    with tempfile.TemporaryDirectory() as output:
+        result = ts.run_single_shift_baseml(tree, Path(output), ctl_template, jobs=jobs, warm_start=warm_start)
+    baseml_seconds = sum(seconds for (_, name), (_, seconds) in trace.tracer.totals.items() if name == "baseml")
+    return result, baseml_seconds
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold vs warm-started baseml on NNI neighbors")
+    parser.add_argument("-s", "--seq", type=Path, nargs="+", required=True, help="PHYLIP alignments")
+    parser.add_argument("-t", "--template", type=Path, default=SRC / "tests/files/hky_template.ctl")
+    parser.add_argument("-B", "--baseml", type=valid_executable, default="baseml")
+    parser.add_argument("-n", "--neighbors", type=int, default=4, help="neighbors per alignment")
+    parser.add_argument("-j", "--jobs", type=int, default=1)
+    parser.add_argument("-o", "--output", type=Path, default=Path("warm_start.jsonl"))
+    args = parser.parse_args()
+    ts.BASEML_EXECUTABLE = args.baseml
+    trace.tracer.configure(True)
+
+    print(f"{'alignment':<40} {'tree':>4} {'cold s':>8} {'warm s':>8} {'lnL warm - cold':>16}", flush=True)
+    total_cold = total_warm = 0.0
+    with open(args.output, 'a') as fo:
+        for seq_path in args.seq:
+            with open(args.template, 'r') as fi:
+                ctl_template = fi.read().replace("#SEQFILE", str(seq_path.absolute()))
+            alignment = ts.AlignIO.read(seq_path, "phylip-relaxed")
+            parent, _ = evaluate(ts.nj_tree(alignment), ctl_template, args.jobs, False)
+            for tree_num, neighbor in enumerate(ts.nearest_neighbors(parent["tree"])[:args.neighbors]):
+                cold, cold_seconds = evaluate(neighbor, ctl_template, args.jobs, False)
+                warm, warm_seconds = evaluate(neighbor, ctl_template, args.jobs, True)
+                difference = warm["log likelihood"] - cold["log likelihood"]
+                total_cold += cold_seconds
+                total_warm += warm_seconds
+                fo.write(json.dumps({
+                    "alignment" : str(seq_path), "tree" : tree_num,
+                    "cold seconds" : cold_seconds, "warm seconds" : warm_seconds,
+                    "cold log likelihood" : cold["log likelihood"], "warm log likelihood" : warm["log likelihood"]
+                }) + "\n")
+                print(f"{str(seq_path)[-40:]:<40} {tree_num:>4} {cold_seconds:>8.2f} {warm_seconds:>8.2f} {difference:>16.4f}", flush=True)
+    if total_cold > 0:
+        print(f"baseml time: {total_cold:.1f}s cold, {total_warm:.1f}s warm ({total_warm / total_cold:.2f}x)")
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,100 @@
 #!/usr/bin/env python3
 import argparse
+import copy
 import treesearch as ts
 import logging
+import random
+import time
+import ete3
 
 from pathlib import Path
-from Bio import AlignIO
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
 from mpi4py import MPI
 from nhts import make_parser
-from numpy import array_split
+from utils import trace
+from utils.checkpoint import Checkpointer
+from utils.multistart import SharedCenters
+from utils import wire
+from utils.workspace import remove_path
+from numpy import array_split, argmax, percentile
+
+TAG_WORK = 1
+TAG_RESULT = 2
+TAG_STOP = 3
+TAG_CANCEL = 4
+TAG_BEST = 5
+
 def crude_partition(data, n):
     # i don't really like this, but it works fine enough
     # return [data[i:i+n] for i in range(0, len(data),n)]
     return array_split(data, n)
 
+def close_resources(rank, evaluate):
+    if evaluate.cache is not None:
+        logging.info(f"{rank}: Likelihood cache had {evaluate.cache.hits} hits, {evaluate.cache.misses} misses")
+    evaluate.close()
+
+def keep_local_best(evaluate, result, opath, previous):
+    """
+    Copies result, this rank's new best, out of the scratch space to opath
+    and removes the copy of previous (its old best, or None). Only a
+    rank's best can end up the global best, so nothing else has to stay
+    in the output directory.
+    """
+    evaluate.keep(result, opath)
+    if previous is not None:
+        remove_path(previous["Path"].parent)
+
+def prune_runs(output, best_path):
+    """
+    For rank 0 once every rank is done: removes the runs that were kept
+    along the way, except the one best_path (the search's result, or None)
+    is in, like serial_single_shift_search does
+    """
+    for pattern in ("step_*", "r*_step_*", "r*_spec_*"):
+        for p in output.glob(pattern):
+            if best_path is None or not Path(best_path).is_relative_to(p):
+                remove_path(p)
+
+def report_limits(comm, args, limits):
+    """
+    Collective. Adds up what happened with --run_timeout on every rank and
+    rank 0 prints it
+    """
+    counts = comm.gather((0, 0, 0) if limits is None else limits.counts(), root=0)
+    if comm.Get_rank() == 0 and args.run_timeout is not None:
+        timed_out, retried, gave_up = (sum(c) for c in zip(*counts))
+        print(f"baseml runs: {timed_out} timed out, {retried} retried, {gave_up} gave up")
+
+def merged_into(shared, best_key, prev_key, likelihood):
+    """
+    For --starts: if this search is moving to a tree another search
+    already moved to, returns that search (see SharedCenters.claim)
+    """
+    if shared is None or best_key == prev_key:
+        return None
+    return shared.claim(best_key, likelihood)
+
+def print_stop(iter_num, ndigits, merged):
+    if merged is None:
+        print(f"{str(iter_num).zfill(ndigits)}:  Did not find a better tree, stopping...")
+    else:
+        print(f"{str(iter_num).zfill(ndigits)}:  Start {merged} already searched from this tree, stopping...")
+
+def print_result(tree, path):
+    # tree is None when no run got a score (every one failed or timed out)
+    if tree is None:
+        print("no tree could be scored")
+        return
+    print(f"Best tree topology:", tree.write(format=9))
+    print("see results in ", path)
+
+def search_summary(likelihood, tree, path, merged):
+    # what a strategy's rank 0 hands back to multi_start (every other rank
+    # returns None); merged is the search this one ran into, if any
+    return {"log likelihood" : likelihood, "newick" : tree.write(format=9), "Path" : path, "merged into" : merged}
+
 def main():
     parser = make_parser()
     args = parser.parse_args()
@@ -21,122 +103,573 @@ def main():
         format="%(asctime)s %(levelname)-4s %(message)s",
         datefmt="%Y-%m-%d %H:%M:%S"
     )
+    ts.BASEML_EXECUTABLE = args.baseml
+    comm = MPI.COMM_WORLD
+    trace.tracer.configure(args.profile, keep_events=args.trace is not None, rank=comm.Get_rank())
     strategy_map = {
         '1' : strategy_1,
-        '2' : strategy_2
+        '2' : strategy_2,
+        '3' : strategy_3
     }
-    strategy_map[args.mpi_method](args)
+    if args.starts > 1:
+        multi_start(args, strategy_map[args.mpi_method])
+    else:
+        strategy_map[args.mpi_method](args)
+    if trace.tracer.enabled:
+        states = comm.gather(trace.tracer.state(), root=0)
+        if comm.Get_rank() == 0:
+            if args.profile:
+                print(trace.summary(states), flush=True)
+            if args.trace:
+                trace.write_chrome_trace(args.trace, states)
+
+def multi_start(args, strategy):
+    """
+    Several searches at once (--starts). COMM_WORLD is split into one
+    sub-communicator per search, each running the -X strategy in its own
+    output directory (start_<i>), from its own starting tree: --start for
+    the first one, random trees for the rest.
+
+    The searches share one likelihood cache (--cache, or one in the output
+    directory), so a tree that one of them already scored never goes
+    through baseml again, and a SharedCenters table, so a search stops as
+    soon as it moves to a tree another search already moved to. Rank 0
+    reports every search's best tree and the best overall.
+    """
+    world = MPI.COMM_WORLD
+    rank = world.Get_rank()
+    # every search needs at least one rank, two for the dynamic queue
+    min_size = 2 if args.mpi_method == '3' else 1
+    n_starts = max(1, min(args.starts, world.Get_size() // min_size))
+    if rank == 0 and n_starts < args.starts:
+        logging.warning(f"Only enough processes for {n_starts} searches")
+    search = rank % n_starts
+    comm = world.Split(search, rank)
+
+    if args.cache is None:
+        args.cache = args.output / "likelihoods.sqlite"
+    centers_path = args.output / "centers.sqlite"
+    if rank == 0:
+        args.output.mkdir(parents=True, exist_ok=True)
+        if not args.resume:
+            # claims from an old run would stop every search right away
+            for suffix in ("", "-journal"):
+                remove_path(Path(f"{centers_path}{suffix}"))
+    world.Barrier()
+
+    search_args = copy.copy(args)
+    search_args.output = args.output / f"start_{search}"
+    if search > 0:
+        search_args.start = "random"
+        if args.seed:
+            search_args.seed = args.seed + search
+    shared = SharedCenters(centers_path, search) if comm.Get_rank() == 0 else None
+    summary = strategy(search_args, comm, shared)
+    if shared is not None:
+        shared.close()
+    comm.Free()
 
-def strategy_1(args):
+    summaries = world.gather((search, summary), root=0)
+    if rank == 0:
+        summaries = sorted((search, summary) for search, summary in summaries if summary is not None)
+        for search, summary in summaries:
+            stopped = "" if summary["merged into"] is None else f" (stopped, reached start {summary['merged into']}'s path)"
+            print(f"start {search}: {summary['log likelihood']} {summary['newick']}{stopped}")
+        if summaries:
+            search, best = max(summaries, key=lambda x : x[1]["log likelihood"])
+            print(f"Best of {len(summaries)} starts (start {search}):", best["newick"])
+            print("see results in ", best["Path"])
+
+def strategy_1(args, comm=None, shared=None):
     """
     This strategy just distributes the work of each neighborhood 
     across all the processes. Rank 0 is in charge of doing that.
     """
-    comm = MPI.COMM_WORLD
+    if comm is None:
+        comm = MPI.COMM_WORLD
     rank = comm.Get_rank()
     comm_size = comm.Get_size()
+    summary = None
+    merged = None
+    if args.speculate:
+        return strategy_1_speculative(args, comm, shared)
     if rank == 0:
         logging.info(f"Using strategy 1 (arg: {args.mpi_method})")
     
-    with open(args.template, 'r') as fi:
-        ctl_template = "".join(fi.read())
-    ctl_template = ctl_template.replace("#SEQFILE", str(args.seq.absolute()))
+    evaluate = ts.Evaluator(args, rank)
+    checkpoint = Checkpointer(args.output)
+    state = None
+    if rank == 0 and args.resume:
+        state = checkpoint.load()
+        if state is None:
+            logging.warning(f"No checkpoint found at {checkpoint.path}, starting from scratch")
+    # everyone picks the iteration and step counters back up from the checkpoint
+    # (step numbers only ever go up so old output directories don't get reused)
+    start_iter, start_step = comm.bcast((state["iteration"], state["step"]) if state else (0, 0), root=0)
+    # trees only need their branch lengths when they're warm starts
+    tree_format = 5 if args.warm_start else 9
     
     if rank == 0: # director
         ndigits = len(str(args.max_iter))
-        logging.debug(f"{rank}: Choosing starting tree and constructing NNI neighborhood")
-        # Get initial trees
-        alignment = AlignIO.read(args.seq, format="phylip-relaxed")
-        if args.start == 'nj':
-            visited_trees = [ts.nj_tree(alignment)]
-        elif args.start == 'random':
-            visited_trees = [ts.random_tree(alignment)]
+        stepnum = start_step
+        n_dispatched = start_step
+
+        l_best_likelihood = float('-inf')
+        l_best_info = None
+        if state is not None:
+            logging.info(f"Resuming from iteration {start_iter}")
+            random.setstate(state["rng"])
+            index = state["index"]
+            prev_key = state["prev key"]
+            visited_keys = state["visited"]
+            n_skipped = state["skipped"]
+            neighbors = state["pending"]
+            g_best_info = state["best info"]
         else:
-            raise NotImplementedError(f"{args.starting_tree} strategy not implemented")
-        del alignment
+            logging.debug(f"{rank}: Choosing starting tree and constructing NNI neighborhood")
+            # Get initial trees
+            if args.seed:
+                random.seed(args.seed)
+            best_tree = ts.starting_tree(args)
 
-        stepnum = 0
-        best_tree = visited_trees[0]
-        prev_tree = best_tree
+            index = ts.taxon_index(best_tree)
+            prev_key = ts.topology_key(best_tree, index)
+            n_skipped = 0
 
-        neighbors = ts.nearest_neighbors(best_tree)
-        visited_trees += neighbors
-        neigbors = [best_tree] + neighbors
+            neighbors, _ = ts.unvisited_neighbors(best_tree, {prev_key}, index)
+            visited_keys = {prev_key} | {key for key, _ in neighbors}
+            neighbors = [best_tree] + [t for _, t in neighbors]
 
-        l_best_likelihood = float('-inf')
-        l_best_info = None
-        g_best_likelihood = float('-inf')
-        g_best_info = {"log likelihood" : float('-inf')}
+            g_best_info = {"log likelihood" : float('-inf')}
+        g_best_likelihood = g_best_info["log likelihood"]
 
         stop_working = False
         
-        for iter_num in range(args.max_iter):
+        for iter_num in range(start_iter, args.max_iter):
+            trace.set_iteration(iter_num)
+            # written in the background, the workers are waiting on the scatter
+            with trace.phase("checkpoint"):
+                checkpoint.save({
+                    "rng" : random.getstate(),
+                    "iteration" : iter_num,
+                    "step" : n_dispatched,
+                    "index" : index,
+                    "prev key" : prev_key,
+                    "visited" : visited_keys,
+                    "skipped" : n_skipped,
+                    "pending" : neighbors,
+                    "best info" : g_best_info
+                })
+            n_dispatched += len(neighbors)
             partition = crude_partition(neighbors, comm_size)
             partition = [partition[-1]] + partition[:-1]
             logging.debug(f"{rank}: Sending neighborhood to processes")
-            next_trees = comm.scatter(partition, root=0) 
+            with trace.phase("scatter"):
+                next_trees = wire.scatter_trees(comm, partition, tree_format)
             logging.debug(f"{rank}: Finished sending, Received neighborhood of size {len(next_trees)}")
             for tree in next_trees:
                 opath = Path(f"{args.output}/r{rank}_step_{stepnum}")
-                result = ts.run_single_shift_baseml(tree, opath, ctl_template)
+                with trace.phase("evaluate"):
+                    result = evaluate(tree, opath)
                 if result["log likelihood"] > l_best_likelihood:
+                    keep_local_best(evaluate, result, opath, l_best_info)
                     l_best_likelihood = result["log likelihood"]
                     l_best_info = result
                     l_best_tree = result["tree"]
                 stepnum += 1
-            # gather the best trees
-            local_results = comm.gather(l_best_info, root=0)
-            g_best_info = max([g_best_info] + local_results, key=lambda x : x["log likelihood"])
+            # gather the best likelihoods, and then the whole result from
+            # whoever has the best one, if it beats the best so far
+            with trace.phase("gather"):
+                likelihoods = wire.gather_likelihoods(comm, l_best_likelihood)
+            # ties go to the lowest rank
+            winner = int(argmax(likelihoods))
+            if likelihoods[winner] <= g_best_info["log likelihood"]:
+                winner = wire.STOP
+            with trace.phase("fetch"):
+                g_best_info = wire.fetch_winner(comm, winner, l_best_info) or g_best_info
             g_best_likelihood = g_best_info["log likelihood"]
+            if "tree" not in g_best_info:
+                # nothing got a score, so there's nowhere to go from here
+                with trace.phase("scatter"):
+                    wire.scatter_trees(comm, None, tree_format)
+                break
             best_tree = g_best_info["tree"]
-            if best_tree == prev_tree:
+            best_key = ts.topology_key(best_tree, index)
+            merged = merged_into(shared, best_key, prev_key, g_best_likelihood)
+            if best_key == prev_key or merged is not None:
                 # send out an empty list and then stop working
-                print(f"{str(iter_num).zfill(ndigits)}:  Did not find a better tree, stopping...")
-                next_trees = comm.scatter([None] * comm_size, root=0)
+                print_stop(iter_num, ndigits, merged)
+                with trace.phase("scatter"):
+                    wire.scatter_trees(comm, None, tree_format)
                 break
             else:
-                prev_tree = best_tree
-                unfiltered_neighbors = ts.nearest_neighbors(best_tree)
-                neighbors = []
-                for t in unfiltered_neighbors:
-                    dont_skip = True
-                    # this is terrible, really
-                    for v in visited_trees:
-                        if t.compare(v, unrooted=True)['norm_rf'] == 0:
-                            dont_skip = False
-                            break
-                    if dont_skip:
-                        neighbors.append(t)
+                prev_key = best_key
+                with trace.phase("neighborhood"):
+                    neighbors, skipped = ts.unvisited_neighbors(best_tree, visited_keys, index)
+                n_skipped += skipped
+                visited_keys.update(key for key, _ in neighbors)
+                neighbors = [t for _, t in neighbors]
             print(f"{str(iter_num).zfill(ndigits)}:  {g_best_likelihood}", flush=True)
+        checkpoint.wait()
         
-        print(f"Best tree topology:", g_best_info["tree"].write(format=9))
-        print("see results in ", g_best_info["Path"])
+        logging.info(f"Skipped {n_skipped} previously visited trees")
+        print_result(g_best_info.get("tree"), g_best_info.get("Path"))
+        if "tree" in g_best_info:
+            summary = search_summary(g_best_info["log likelihood"], g_best_info["tree"], g_best_info["Path"], merged)
     else: # worker
         # rank, step num in output name
         # wait for my tree
-        stepnum = 0
+        stepnum = start_step
         
         l_best_likelihood = float('-inf')
         l_best_info = None
         
-        for iter_num in range(args.max_iter):
-            next_trees = comm.scatter(None, root=0)
-            logging.debug(f"{rank}: Received neighborhood of size {len(next_trees)}")
+        for iter_num in range(start_iter, args.max_iter):
+            trace.set_iteration(iter_num)
+            with trace.phase("scatter"):
+                next_trees = wire.receive_trees(comm)
             if next_trees is None:
                 # kind of crude - what if one process doesn't have neighboring trees for one iteration ? 
                 # it just stops doing work forever?
                 break
+            logging.debug(f"{rank}: Received neighborhood of size {len(next_trees)}")
             for tree in next_trees:
                 opath = Path(f"{args.output}/r{rank}_step_{stepnum}")
-                result = ts.run_single_shift_baseml(tree, opath, ctl_template)
+                with trace.phase("evaluate"):
+                    result = evaluate(tree, opath)
                 if result["log likelihood"] > l_best_likelihood:
+                    keep_local_best(evaluate, result, opath, l_best_info)
                     l_best_likelihood = result["log likelihood"]
                     l_best_info = result
                     l_best_tree = result["tree"]
                 stepnum += 1
-            comm.gather(l_best_info, root=0)
+            with trace.phase("gather"):
+                wire.gather_likelihoods(comm, l_best_likelihood)
+            with trace.phase("fetch"):
+                wire.fetch_winner(comm, None, l_best_info)
+    report_limits(comm, args, evaluate.limits)
+    if rank == 0:
+        prune_runs(args.output, None if summary is None else summary["Path"])
+    close_resources(rank, evaluate)
+    return summary
+
+def strategy_1_speculative(args, comm=None, shared=None):
+    """
+    Strategy 1 with --speculate. The neighborhood is split up the same way,
+    but a worker that's done with its share doesn't just sit waiting for
+    the slowest rank. Rank 0 collects the local bests as they come in and
+    whenever one beats the best so far (so it could be the next center) it
+    sends that tree to every worker. Workers that are done evaluate its
+    unvisited neighbors, switching over when a better tree comes along.
+    Every worker keeps its own copy of the visited trees, so this
+    iteration's neighborhood isn't evaluated twice.
+
+    Rank 0 then tells everyone which tree won. Workers that speculated on
+    it let the run they're in the middle of finish, keep their runs and
+    send back their topology keys, and rank 0 leaves those trees out of
+    the next split. Everyone else kills their speculative runs and
+    throws the results away. Workers have to notice rank 0's messages
+    while baseml is running, so the scatter/gather are point-to-point
+    messages here, and rank 0 runs its own share in the background.
+    """
+    if comm is None:
+        comm = MPI.COMM_WORLD
+    rank = comm.Get_rank()
+    comm_size = comm.Get_size()
+    summary = None
+    merged = None
+    if rank == 0:
+        logging.info(f"Using strategy 1 with speculation (arg: {args.mpi_method})")
+
+    evaluate = ts.Evaluator(args, rank)
+    pool = ThreadPoolExecutor(max_workers=1)
+
+    l_best_likelihood = float('-inf')
+    l_best_info = None
+    def evaluate_share(trees, base):
+        nonlocal l_best_likelihood, l_best_info
+        for i, tree in enumerate(trees):
+            opath = Path(f"{args.output}/r{rank}_step_{base + i}")
+            with trace.phase("evaluate"):
+                result = evaluate(tree, opath)
+            if result and result["log likelihood"] > l_best_likelihood:
+                keep_local_best(evaluate, result, opath, l_best_info)
+                l_best_likelihood = result["log likelihood"]
+                l_best_info = result
+
+    if rank == 0: # director
+        ndigits = len(str(args.max_iter))
+        checkpoint = Checkpointer(args.output)
+        state = checkpoint.load() if args.resume else None
+        if state is not None:
+            logging.info(f"Resuming from iteration {state['iteration']}")
+            random.setstate(state["rng"])
+            start_iter = state["iteration"]
+            n_dispatched = state["step"]
+            index = state["index"]
+            prev_key = state["prev key"]
+            visited_keys = state["visited"]
+            n_skipped = state["skipped"]
+            neighbors = state["pending"]
+            g_best_info = state["best info"]
+        else:
+            if args.resume:
+                logging.warning(f"No checkpoint found at {checkpoint.path}, starting from scratch")
+            if args.seed:
+                random.seed(args.seed)
+            best_tree = ts.starting_tree(args)
+
+            start_iter = 0
+            n_dispatched = 0
+            index = ts.taxon_index(best_tree)
+            prev_key = ts.topology_key(best_tree, index)
+            n_skipped = 0
+
+            neighbors, _ = ts.unvisited_neighbors(best_tree, {prev_key}, index)
+            visited_keys = {prev_key} | {key for key, _ in neighbors}
+            neighbors = [best_tree] + [t for _, t in neighbors]
+
+            g_best_info = {"log likelihood" : float('-inf')}
+        n_used = 0
+        # visited trees the workers haven't been told about yet
+        unsent = set(visited_keys)
+
+        def collect(own, iter_num, provisional):
+            """
+            Every rank's local best, in rank order, once they're all in.
+            Until then, each one that beats the best so far goes out to all
+            the workers so the ones that are done can speculate on it.
+            """
+            results = [None] * comm_size
+            waiting = set(range(1, comm_size))
+            while waiting or own is not None:
+                status = MPI.Status()
+                if own is not None and own.done():
+                    own.result()
+                    worker, result, own = 0, l_best_info, None
+                elif comm.Iprobe(source=MPI.ANY_SOURCE, tag=TAG_RESULT, status=status):
+                    worker = status.Get_source()
+                    with trace.phase("recv"):
+                        result = comm.recv(source=worker, tag=TAG_RESULT)
+                    waiting.discard(worker)
+                else:
+                    time.sleep(0.01)
+                    continue
+                results[worker] = result
+                if result and result["log likelihood"] > provisional:
+                    provisional = result["log likelihood"]
+                    with trace.phase("send"):
+                        for other in range(1, comm_size):
+                            comm.send((iter_num, result["tree"]), dest=other, tag=TAG_BEST)
+            return results
+
+        for iter_num in range(start_iter, args.max_iter):
+            trace.set_iteration(iter_num)
+            with trace.phase("checkpoint"):
+                checkpoint.save({
+                    "rng" : random.getstate(),
+                    "iteration" : iter_num,
+                    "step" : n_dispatched,
+                    "index" : index,
+                    "prev key" : prev_key,
+                    "visited" : visited_keys,
+                    "skipped" : n_skipped,
+                    "pending" : neighbors,
+                    "best info" : g_best_info
+                })
+            partition = crude_partition(neighbors, comm_size)
+            partition = [partition[-1]] + partition[:-1]
+            with trace.phase("send"):
+                for worker in range(1, comm_size):
+                    task = (iter_num, n_dispatched, list(partition[worker]), index, unsent)
+                    comm.send(("work", task), dest=worker, tag=TAG_WORK)
+            unsent = set()
+            own = pool.submit(evaluate_share, partition[0], n_dispatched)
+            n_dispatched += len(neighbors)
+            local_results = collect(own, iter_num, g_best_info["log likelihood"])
+            for result in local_results:
+                if result and result["log likelihood"] > g_best_info["log likelihood"]:
+                    g_best_info = result
+            if "tree" not in g_best_info:
+                # nothing got a score, so there's nowhere to go from here
+                break
+            best_tree = g_best_info["tree"]
+            best_key = ts.topology_key(best_tree, index)
+            merged = merged_into(shared, best_key, prev_key, g_best_info["log likelihood"])
+            if best_key == prev_key or merged is not None:
+                print_stop(iter_num, ndigits, merged)
+                break
+            with trace.phase("send"):
+                for worker in range(1, comm_size):
+                    comm.send(("winner", best_key), dest=worker, tag=TAG_WORK)
+            speculated = set()
+            with trace.phase("recv"):
+                for worker in range(1, comm_size):
+                    speculated |= comm.recv(source=worker, tag=TAG_RESULT)
+            prev_key = best_key
+            with trace.phase("neighborhood"):
+                neighbors, skipped = ts.unvisited_neighbors(best_tree, visited_keys, index)
+            n_skipped += skipped
+            visited_keys.update(key for key, _ in neighbors)
+            unsent = {key for key, _ in neighbors}
+            # some worker already has these, and its best of them comes back with
+            # its local best next iteration
+            n_used += sum(key in speculated for key, _ in neighbors)
+            neighbors = [t for key, t in neighbors if key not in speculated]
+            print(f"{str(iter_num).zfill(ndigits)}:  {g_best_info['log likelihood']}", flush=True)
+
+        with trace.phase("send"):
+            for worker in range(1, comm_size):
+                comm.send(("stop", None), dest=worker, tag=TAG_WORK)
+        counts = comm.gather(None, root=0)
+        pool.shutdown()
+        checkpoint.wait()
+
+        n_speculated = sum(c[0] for c in counts[1:])
+        n_cancelled = sum(c[1] for c in counts[1:])
+        logging.info(f"Skipped {n_skipped} previously visited trees")
+        print(f"speculative evaluations: {n_used} used, {n_speculated - n_used + n_cancelled} wasted ({n_cancelled} cancelled)")
+        print_result(g_best_info.get("tree"), g_best_info.get("Path"))
+        if "tree" in g_best_info:
+            summary = search_summary(g_best_info["log likelihood"], g_best_info["tree"], g_best_info["Path"], merged)
+    else: # worker
+        n_speculated = 0
+        n_cancelled = 0
+        # the director's visited trees, it sends what's new with every share
+        visited_keys = set()
+        index = None
+
+        def speculate(iter_num):
+            """
+            Evaluates the unvisited neighbors of the best tree so far this
+            iteration, which rank 0 sends whenever it changes, until rank 0
+            says what won. Each rank starts at its own point of the list so
+            ranks on the same center mostly don't overlap. Returns rank 0's
+            decision, the key of the center, the (key, result) pairs that
+            finished for it, the output directories that were kept for them,
+            and how many runs finished and got cancelled in all.
+            """
+            center_key = None
+            todo = deque()
+            finished, kept = [], []
+            best_likelihood = l_best_likelihood
+            n_finished = 0
+            n_cancelled = 0
+            n_started = 0
+            decision = None
+            new_center = None
 
-def strategy_2(args):
+            def check_messages():
+                # True once there's either rank 0's decision or a new center
+                nonlocal decision, new_center
+                if comm.Iprobe(source=0, tag=TAG_WORK):
+                    decision = comm.recv(source=0, tag=TAG_WORK)
+                    return True
+                while comm.Iprobe(source=0, tag=TAG_BEST):
+                    best_iter, center = comm.recv(source=0, tag=TAG_BEST)
+                    # anything else is left over from an iteration this rank is done with
+                    if best_iter == iter_num:
+                        new_center = center
+                        return True
+                return False
+
+            while decision is None:
+                if new_center is not None:
+                    # nothing done for the old center is any use now
+                    for path in kept:
+                        remove_path(path)
+                    center_key = ts.topology_key(new_center, index)
+                    neighbors, _ = ts.unvisited_neighbors(new_center, visited_keys, index)
+                    offset = rank * len(neighbors) // comm_size
+                    todo = deque(neighbors[offset:] + neighbors[:offset])
+                    finished, kept = [], []
+                    best_likelihood = l_best_likelihood
+                    new_center = None
+                    continue
+                if check_messages():
+                    continue
+                if not todo:
+                    time.sleep(0.01)
+                    continue
+                key, tree = todo.popleft()
+                opath = Path(f"{args.output}/r{rank}_spec_{iter_num}_{n_started}")
+                n_started += 1
+                cancel = ts.Cancellation()
+                future = pool.submit(evaluate, tree, opath, cancel=cancel)
+                while not future.done():
+                    # a new center, or rank 0 picking some other tree (or
+                    # stopping), makes this run pointless. If this center won,
+                    # it gets to finish
+                    if decision is None and check_messages():
+                        if new_center is not None or decision != ("winner", center_key):
+                            cancel.cancel()
+                            break
+                    wait([future], timeout=0.01)
+                try:
+                    result = future.result()
+                except ts.Cancelled:
+                    logging.debug(f"{rank}: Cancelled speculative run {n_started} after {len(finished)} finished")
+                    n_cancelled += 1
+                    continue
+                n_finished += 1
+                if not result:
+                    continue
+                # the workspace slot gets reused by the next run, so anything
+                # that might end up this rank's best is copied out now
+                if result["log likelihood"] > best_likelihood:
+                    evaluate.keep(result, opath)
+                    kept.append(opath)
+                    best_likelihood = result["log likelihood"]
+                finished.append((key, result))
+            return decision, center_key, finished, kept, n_finished, n_cancelled
+
+        while True:
+            with trace.phase("recv"):
+                kind, task = comm.recv(source=0, tag=TAG_WORK)
+            if kind == "stop":
+                break
+            iter_num, base, trees, index, new_keys = task
+            visited_keys.update(new_keys)
+            trace.set_iteration(iter_num)
+            evaluate_share(trees, base)
+            with trace.phase("send"):
+                comm.send(l_best_info, dest=0, tag=TAG_RESULT)
+            with trace.phase("speculate"):
+                (kind, winner_key), center_key, finished, kept, n_finished, cancelled = speculate(iter_num)
+            n_speculated += n_finished
+            n_cancelled += cancelled
+            if kind == "winner" and center_key == winner_key:
+                logging.debug(f"{rank}: Speculated on the winning tree, {len(finished)} runs finished")
+                # whichever of the old best and the kept runs is best stays
+                stale = kept + ([] if l_best_info is None else [l_best_info["Path"].parent])
+                for key, result in finished:
+                    if result["log likelihood"] > l_best_likelihood:
+                        l_best_likelihood = result["log likelihood"]
+                        l_best_info = result
+                for path in stale:
+                    if path != l_best_info["Path"].parent:
+                        remove_path(path)
+                speculated = {key for key, _ in finished}
+            else:
+                for path in kept:
+                    remove_path(path)
+                speculated = set()
+            if kind == "stop":
+                break
+            with trace.phase("send"):
+                comm.send(speculated, dest=0, tag=TAG_RESULT)
+        # best trees nobody got to before the end
+        while comm.Iprobe(source=0, tag=TAG_BEST):
+            comm.recv(source=0, tag=TAG_BEST)
+        pool.shutdown()
+        comm.gather((n_speculated, n_cancelled), root=0)
+    report_limits(comm, args, evaluate.limits)
+    if rank == 0:
+        prune_runs(args.output, None if summary is None else summary["Path"])
+    close_resources(rank, evaluate)
+    return summary
+
+def strategy_2(args, comm=None, shared=None):
     """
     For this strategy, each thread does the same thing
     allgather visited trees
@@ -145,14 +678,408 @@ def strategy_2(args):
     visited trees kept track in a set
     trees are encoded by a bipartition of leaves
 
+    Every rank builds the same neighborhood from the same best tree and
+    takes every comm_size-th tree of it, so nothing gets scattered and
+    rank 0 is just another worker. The only thing that moves around is
+    the winning tree, sent as a newick string by whoever found it.
     """
-    comm = MPI.COMM_WORLD
+    if comm is None:
+        comm = MPI.COMM_WORLD
     rank = comm.Get_rank()
     comm_size = comm.Get_size()
+    summary = None
+    merged = None
     if rank == 0:
         logging.info(f"Using strategy 2 (arg: {args.mpi_method})")
-        logging.error("Not yet implemented")
+    
+    evaluate = ts.Evaluator(args, rank)
+
+    ndigits = len(str(args.max_iter))
+    checkpoint = Checkpointer(args.output)
+    state = None
+    if rank == 0 and args.resume:
+        state = checkpoint.load()
+        if state is None:
+            logging.warning(f"No checkpoint found at {checkpoint.path}, starting from scratch")
+    state = comm.bcast(state, root=0)
+
+    if state is not None:
+        if rank == 0:
+            logging.info(f"Resuming from iteration {state['iteration']}")
+        random.setstate(state["rng"])
+        start_iter = state["iteration"]
+        n_dispatched = state["step"]
+        index = state["index"]
+        prev_key = state["prev key"]
+        visited_keys = state["visited"]
+        n_skipped = state["skipped"]
+        neighbors = state["pending"]
+        g_best = state["best"]
+    else:
+        # everyone has to start from the same tree (matters for --start random)
+        if rank == 0:
+            if args.seed:
+                random.seed(args.seed)
+            start_newick = ts.starting_tree(args).write(format=5)
+        else:
+            start_newick = None
+        best_tree = ete3.Tree(comm.bcast(start_newick, root=0))
+        index = ts.taxon_index(best_tree)
+        prev_key = ts.topology_key(best_tree, index)
+        visited_keys = {prev_key}
+        n_skipped = 0
+
+        neighbors, _ = ts.unvisited_neighbors(best_tree, visited_keys, index)
+        visited_keys.update(key for key, _ in neighbors)
+        neighbors = [best_tree] + [t for _, t in neighbors]
+
+        start_iter = 0
+        n_dispatched = 0
+        g_best = {"log likelihood" : float('-inf'), "newick" : None, "Path" : None}
+
+    # a rank only reports a tree if it beats the best one so far
+    l_best_likelihood = g_best["log likelihood"]
+    l_best_info = None
+
+    for iter_num in range(start_iter, args.max_iter):
+        trace.set_iteration(iter_num)
+        if rank == 0:
+            with trace.phase("checkpoint"):
+                checkpoint.save({
+                    "rng" : random.getstate(),
+                    "iteration" : iter_num,
+                    "step" : n_dispatched,
+                    "index" : index,
+                    "prev key" : prev_key,
+                    "visited" : visited_keys,
+                    "skipped" : n_skipped,
+                    "pending" : neighbors,
+                    "best" : g_best
+                })
+        # every rank numbers its steps from the same count, so step numbers keep
+        # going up across a resume and old output directories don't get reused
+        stepnum = n_dispatched
+        n_dispatched += len(neighbors)
+        my_keys = []
+        for tree in neighbors[rank::comm_size]:
+            opath = Path(f"{args.output}/r{rank}_step_{stepnum}")
+            with trace.phase("evaluate"):
+                result = evaluate(tree, opath)
+            my_keys.append(ts.topology_key(tree, index))
+            if result["log likelihood"] > l_best_likelihood:
+                keep_local_best(evaluate, result, opath, l_best_info)
+                l_best_likelihood = result["log likelihood"]
+                l_best_info = result
+            stepnum += 1
+        # merge what everyone evaluated so the neighborhoods stay in sync
+        with trace.phase("allgather"):
+            all_keys = comm.allgather(my_keys)
+        for keys in all_keys:
+            visited_keys.update(keys)
+        # ties go to the lowest rank
+        with trace.phase("allreduce"):
+            g_best_likelihood, winner = comm.allreduce((l_best_likelihood, rank), op=MPI.MAXLOC)
+        if rank == winner and l_best_info is not None:
+            payload = {
+                "log likelihood" : l_best_likelihood,
+                "newick" : l_best_info["tree"].write(format=5),
+                "Path" : l_best_info["Path"]
+            }
+        else:
+            payload = None
+        with trace.phase("bcast"):
+            g_best = comm.bcast(payload, root=winner) or g_best
+        if g_best["newick"] is None:
+            # nothing was evaluated anywhere, nowhere to go from here
+            break
+        best_tree = ete3.Tree(g_best["newick"])
+        best_key = ts.topology_key(best_tree, index)
+        # only rank 0 has the shared table, so it decides for everyone
+        merged = comm.bcast(merged_into(shared, best_key, prev_key, g_best_likelihood), root=0) if args.starts > 1 else None
+        if best_key == prev_key or merged is not None:
+            if rank == 0:
+                print_stop(iter_num, ndigits, merged)
+            break
+        prev_key = best_key
+        with trace.phase("neighborhood"):
+            neighbors, skipped = ts.unvisited_neighbors(best_tree, visited_keys, index)
+        n_skipped += skipped
+        neighbors = [t for _, t in neighbors]
+        if rank == 0:
+            print(f"{str(iter_num).zfill(ndigits)}:  {g_best_likelihood}", flush=True)
+
+    if rank == 0:
+        checkpoint.wait()
+        logging.info(f"Skipped {n_skipped} previously visited trees")
+        best_tree = None if g_best["newick"] is None else ete3.Tree(g_best["newick"])
+        print_result(best_tree, g_best["Path"])
+        if best_tree is not None:
+            summary = search_summary(g_best["log likelihood"], best_tree, g_best["Path"], merged)
+    report_limits(comm, args, evaluate.limits)
+    if rank == 0:
+        prune_runs(args.output, g_best["Path"])
+    close_resources(rank, evaluate)
+    return summary
+
+def strategy_3(args, comm=None, shared=None):
+    """
+    Same search as strategy 1, but instead of splitting each neighborhood
+    up front, rank 0 keeps it as a queue and hands out one tree at a time.
+    A worker gets its next tree as soon as it sends back the result of the
+    last one, so fast ranks pull more of the work and nobody sits on a
+    slice that happened to be full of slow baseml runs.
+
+    Rank 0 only hands out work here, so this needs at least 2 processes.
+    Each worker keeps track of how long it spent in baseml vs waiting and
+    rank 0 reports it at the end.
 
+    With --climb first/stochastic, rank 0 moves as soon as a result beats
+    the best so far: the rest of the queue is dropped and the workers still
+    on that neighborhood are told to kill their baseml runs. Trees only go
+    into visited_keys when they're handed out, and come back out if their
+    run gets cancelled, so they can still be visited from the new center.
+    """
+    if comm is None:
+        comm = MPI.COMM_WORLD
+    rank = comm.Get_rank()
+    comm_size = comm.Get_size()
+    summary = None
+    merged = None
+    if rank == 0:
+        logging.info(f"Using strategy 3 (arg: {args.mpi_method})")
+    if comm_size < 2:
+        if rank == 0:
+            logging.error("Strategy 3 needs at least 2 processes")
+        return
+
+    if rank == 0: # director
+        ndigits = len(str(args.max_iter))
+        first_improvement = args.climb != "best"
+        checkpoint = Checkpointer(args.output)
+        state = checkpoint.load() if args.resume else None
+        if state is not None:
+            logging.info(f"Resuming from iteration {state['iteration']}")
+            random.setstate(state["rng"])
+            start_iter = state["iteration"]
+            stepnum = state["step"]
+            index = state["index"]
+            prev_key = state["prev key"]
+            visited_keys = state["visited"]
+            n_skipped = state["skipped"]
+            neighbors = state["pending"]
+            g_best = state["best"]
+        else:
+            if args.resume:
+                logging.warning(f"No checkpoint found at {checkpoint.path}, starting from scratch")
+            if args.seed:
+                random.seed(args.seed)
+            best_tree = ts.starting_tree(args)
+
+            start_iter = 0
+            stepnum = 0
+            index = ts.taxon_index(best_tree)
+            prev_key = ts.topology_key(best_tree, index)
+            n_skipped = 0
+
+            # (key, tree) pairs, keys go into visited_keys as they're handed out
+            neighbors = [(prev_key, best_tree)]
+            if first_improvement:
+                # the starting tree has to be scored before anything can beat it
+                prev_key = None
+            else:
+                more, _ = ts.unvisited_neighbors(best_tree, {prev_key}, index)
+                neighbors += more
+            visited_keys = set()
+
+            g_best = {"log likelihood" : float('-inf'), "newick" : None, "Path" : None}
+        idle = list(range(1, comm_size))
+        n_evaluated = 0
+        n_cancelled = 0
+        # how long finished runs took, for --redispatch
+        durations = []
+        n_redispatched = 0
+        n_copy_first = 0
+
+        for iter_num in range(start_iter, args.max_iter):
+            trace.set_iteration(iter_num)
+            with trace.phase("checkpoint"):
+                checkpoint.save({
+                    "rng" : random.getstate(),
+                    "iteration" : iter_num,
+                    "step" : stepnum,
+                    "index" : index,
+                    "prev key" : prev_key,
+                    "visited" : visited_keys,
+                    "skipped" : n_skipped,
+                    "pending" : neighbors,
+                    "best" : g_best
+                })
+            if args.climb == "stochastic":
+                # before it's a deque, shuffling one is O(n^2)
+                random.shuffle(neighbors)
+            pending = deque(neighbors)
+            # worker -> (key, newick, when it was sent, whether it's a second copy of a straggler, step number)
+            out = {}
+            # keys with a result this iteration, the other copy of a straggler gets ignored
+            done = set()
+            moved = False
+            logging.debug(f"{rank}: Handing out neighborhood of size {len(pending)}")
+            while pending or out:
+                while idle and pending:
+                    key, tree = pending.popleft()
+                    visited_keys.add(key)
+                    worker = idle.pop()
+                    newick = tree.write(format=5)
+                    with trace.phase("send"):
+                        comm.send((iter_num, stepnum, newick), dest=worker, tag=TAG_WORK)
+                    out[worker] = (key, newick, MPI.Wtime(), False, stepnum)
+                    stepnum += 1
+                status = MPI.Status()
+                with trace.phase("recv"):
+                    # with nothing left to hand out, an idle worker takes a second
+                    # copy of a tree that's been out for longer than the --redispatch
+                    # percentile of the runs so far, and whichever copy finishes first wins
+                    while args.redispatch and not comm.Iprobe(source=MPI.ANY_SOURCE, tag=TAG_RESULT, status=status):
+                        straggler = None
+                        # the percentile means nothing until a few runs are done
+                        if idle and not pending and len(durations) >= 10:
+                            threshold = percentile(durations, args.redispatch)
+                            now = MPI.Wtime()
+                            copied = [key for key, _, _, second, _ in out.values() if second]
+                            running = [(sent, key, newick) for key, newick, sent, _, _ in out.values() if key not in copied and now - sent > threshold]
+                            straggler = min(running, default=None)
+                        if straggler is None:
+                            time.sleep(0.01)
+                            continue
+                        _, key, newick = straggler
+                        worker = idle.pop()
+                        with trace.phase("send"):
+                            comm.send((iter_num, stepnum, newick), dest=worker, tag=TAG_WORK)
+                        out[worker] = (key, newick, MPI.Wtime(), True, stepnum)
+                        stepnum += 1
+                        n_redispatched += 1
+                    result = comm.recv(source=MPI.ANY_SOURCE, tag=TAG_RESULT, status=status)
+                worker = status.Get_source()
+                idle.append(worker)
+                key, _, sent, second, _ = out.pop(worker)
+                others = [busy for busy, (other, _, _, _, _) in out.items() if other == key]
+                if result == "cancelled":
+                    n_cancelled += 1
+                    # it can still be visited from the next center, unless it got done here after all
+                    if key not in done and not others:
+                        visited_keys.discard(key)
+                    continue
+                if key in done:
+                    # the other copy got here first
+                    continue
+                done.add(key)
+                durations.append(MPI.Wtime() - sent)
+                n_evaluated += 1
+                n_copy_first += second
+                with trace.phase("send"):
+                    # cancels name the step they're for, the worker may have
+                    # finished it and moved on by the time this gets there
+                    for busy in others:
+                        comm.send(out[busy][4], dest=busy, tag=TAG_CANCEL)
+                if result and result["log likelihood"] > g_best["log likelihood"]:
+                    g_best = result
+                    if first_improvement and not moved:
+                        moved = True
+                        pending.clear()
+                        with trace.phase("send"):
+                            for busy in out:
+                                if busy not in others:
+                                    comm.send(out[busy][4], dest=busy, tag=TAG_CANCEL)
+            if g_best["newick"] is None:
+                break
+            best_tree = ete3.Tree(g_best["newick"])
+            best_key = ts.topology_key(best_tree, index)
+            merged = merged_into(shared, best_key, prev_key, g_best["log likelihood"])
+            if best_key == prev_key or merged is not None:
+                print_stop(iter_num, ndigits, merged)
+                break
+            prev_key = best_key
+            with trace.phase("neighborhood"):
+                neighbors, skipped = ts.unvisited_neighbors(best_tree, visited_keys, index)
+            n_skipped += skipped
+            print(f"{str(iter_num).zfill(ndigits)}:  {g_best['log likelihood']}", flush=True)
+
+        for worker in range(1, comm_size):
+            comm.send(None, dest=worker, tag=TAG_STOP)
+        timings = comm.gather(None, root=0)
+        report_limits(comm, args, None)
+        prune_runs(args.output, g_best["Path"])
+        checkpoint.wait()
+
+        logging.info(f"Skipped {n_skipped} previously visited trees")
+        for worker, (n_trees, busy, waiting) in enumerate(timings[1:], start=1):
+            total = busy + waiting
+            percent = 100 * busy / total if total > 0 else 0
+            logging.info(f"Rank {worker}: {n_trees} trees, busy {busy:.2f}s, idle {waiting:.2f}s ({percent:.0f}% busy)")
+        print(f"evaluated {n_evaluated} trees, cancelled {n_cancelled}, skipped {n_skipped} previously visited trees")
+        if args.redispatch:
+            print(f"re-dispatched {n_redispatched} stragglers, the second copy finished first for {n_copy_first}")
+        best_tree = None if g_best["newick"] is None else ete3.Tree(g_best["newick"])
+        print_result(best_tree, g_best["Path"])
+        if best_tree is not None:
+            summary = search_summary(g_best["log likelihood"], best_tree, g_best["Path"], merged)
+    else: # worker
+        evaluate = ts.Evaluator(args, rank)
+        pool = ThreadPoolExecutor(max_workers=1)
+        n_trees = 0
+        busy = 0.0
+        l_best_likelihood = float('-inf')
+        l_best_info = None
+        start_time = MPI.Wtime()
+        while True:
+            status = MPI.Status()
+            with trace.phase("recv"):
+                task = comm.recv(source=0, tag=MPI.ANY_TAG, status=status)
+            if status.Get_tag() == TAG_STOP:
+                break
+            if status.Get_tag() == TAG_CANCEL:
+                # meant for a tree that was already done when it got here
+                continue
+            iter_num, stepnum, newick = task
+            trace.set_iteration(iter_num)
+            tic = MPI.Wtime()
+            opath = Path(f"{args.output}/step_{stepnum}")
+            cancel = ts.Cancellation()
+            with trace.phase("evaluate"):
+                # baseml runs in the background so a cancel from rank 0 can kill it
+                future = pool.submit(evaluate, ete3.Tree(newick), opath, cancel=cancel)
+                while not future.done():
+                    if comm.Iprobe(source=0, tag=TAG_CANCEL):
+                        # cancels for steps this rank already finished are stale
+                        if comm.recv(source=0, tag=TAG_CANCEL) == stepnum:
+                            cancel.cancel()
+                            break
+                    wait([future], timeout=0.01)
+                try:
+                    result = future.result()
+                except ts.Cancelled:
+                    result = "cancelled"
+            if result and result != "cancelled":
+                # only this rank's best so far can end up the global best,
+                # nothing else needs to leave the scratch space
+                if result["log likelihood"] > l_best_likelihood:
+                    l_best_likelihood = result["log likelihood"]
+                    keep_local_best(evaluate, result, opath, l_best_info)
+                    l_best_info = result
+                result = {
+                    "log likelihood" : result["log likelihood"],
+                    "newick" : result["tree"].write(format=5),
+                    "Path" : result["Path"]
+                }
+            busy += MPI.Wtime() - tic
+            n_trees += 1
+            with trace.phase("send"):
+                comm.send(result, dest=0, tag=TAG_RESULT)
+        pool.shutdown()
+        comm.gather((n_trees, busy, MPI.Wtime() - start_time - busy), root=0)
+        report_limits(comm, args, evaluate.limits)
+        close_resources(rank, evaluate)
+    return summary
 
 if __name__ == "__main__":
     main()
@@ -5,6 +5,7 @@ import logging
 
 from pathlib import Path
 import treesearch as ts 
+from utils import trace
 
 def valid_file(path_str):
     p = Path(path_str)
@@ -27,12 +28,38 @@ def valid_start_strategy(strat_str):
     else:
         raise Exception(f"Not a valid starting strategy: {strat_str}")
 
+def valid_executable(path_str):
+    # a file gets an absolute path since baseml runs in its output directory,
+    # anything else is left for PATH
+    p = Path(path_str)
+    if p.is_file():
+        return str(p.absolute())
+    return path_str
+
 def is_positive(x):
     ivalue = int(x)
     if ivalue < 1:
         raise argparse.ArgumentTypeError(f"Number of processes must be at least 1 (got {x})")
     return ivalue
 
+def is_nonnegative(x):
+    ivalue = int(x)
+    if ivalue < 0:
+        raise argparse.ArgumentTypeError(f"Must be at least 0 (got {x})")
+    return ivalue
+
+def is_positive_float(x):
+    fvalue = float(x)
+    if not fvalue > 0:
+        raise argparse.ArgumentTypeError(f"Must be greater than 0 (got {x})")
+    return fvalue
+
+def is_percentile(x):
+    fvalue = float(x)
+    if not 0 <= fvalue <= 100:
+        raise argparse.ArgumentTypeError(f"Must be a percentile between 0 and 100 (got {x})")
+    return fvalue
+
 def make_parser():
     parser = argparse.ArgumentParser(
         description="Wrapper for tree search (serial version)"
@@ -43,8 +70,29 @@ def make_parser():
     parser.add_argument("-o", "--output", type=valid_output, help="Directory to output results to", required=True)
     parser.add_argument("-z", "--seed", type=int, help="Seed PRNG")
     parser.add_argument("-S", "--start", type=valid_start_strategy, help="Starting tre strategy: 'random', 'nj', or 'upgma'", default='nj') # for now...
+    parser.add_argument("-D", "--distance", choices=["identity", "p", "jc", "k2p"], default="identity", help="Distance used for 'nj' and 'upgma' starting trees")
     parser.add_argument("-M", "--max_iter", type=int, help="Maximum number of iterations", default=2)
-    parser.add_argument("-X", "--mpi_method", type=str, help="Pick parallelization strategy", default="1")
+    parser.add_argument("-j", "--jobs", type=is_positive, help="Number of baseml runs to execute at once (per MPI process)", default=1)
+    parser.add_argument("-c", "--cache", type=valid_output, help="SQLite file to cache baseml results in (shared between runs and MPI processes)")
+    parser.add_argument("--cache_size", type=is_positive, help="Maximum number of cached baseml results", default=100000)
+    parser.add_argument("-r", "--resume", action="store_true", help="Continue from the checkpoint in the output directory")
+    parser.add_argument("-B", "--baseml", type=valid_executable, help="baseml executable to run (e.g. benchmarks/fake_baseml.py)", default="baseml")
+    parser.add_argument("--profile", action="store_true", help="Time every phase of the search and print a summary at the end")
+    parser.add_argument("--trace", type=valid_output, help="Also write a Chrome trace (JSON timeline) of every phase to this file")
+    parser.add_argument("--scratch", type=valid_output, help="Where to put scratch directories for baseml runs (default: /dev/shm if available, otherwise the system temp directory)")
+    parser.add_argument("--cleanup", choices=["delete", "compress"], default="delete", help="What to do with runs that aren't the best: 'delete' them, or 'compress' them all into archive_r<rank>.dat/.idx in the output directory")
+    parser.add_argument("--screen", type=is_nonnegative, default=0, help="Score every shift placement with branch lengths fixed (fix_blength = 2) first and only fully optimize the best SCREEN of them (default 0: optimize all of them)")
+    parser.add_argument("--screen_margin", type=float, default=0.0, help="With --screen, also fully optimize placements that screened within this many log likelihood units of the best")
+    parser.add_argument("--warm_start", action="store_true", help="Start baseml from the branch lengths estimated for the parent tree (fix_blength = 1) instead of from scratch")
+    parser.add_argument("--shifts", type=is_positive, default=1, help="Number of model shifts to place on each tree. Every placement is tried, C(2n-3, shifts) of them")
+    parser.add_argument("--batch", type=is_positive, default=1, help="Put up to this many shift assignments in one baseml treefile, to pay baseml's startup once for all of them. The batch size adapts to the measured time per tree. 1 runs one tree per process")
+    parser.add_argument("--run_timeout", type=is_positive_float, default=None, help="Kill any baseml run that takes longer than this many seconds")
+    parser.add_argument("--run_retries", type=is_nonnegative, default=0, help="With --run_timeout, start a timed out run again (from a different kappa) this many times before scoring it -inf")
+    parser.add_argument("--redispatch", type=is_percentile, default=0, help="MPI -X 3 only: once the queue is empty, send a copy of any tree that has been out longer than this percentile of the run times so far to an idle worker, and take whichever copy finishes first. 0 turns it off")
+    parser.add_argument("--climb", choices=["best", "first", "stochastic"], default="best", help="'best': evaluate the whole neighborhood before moving. 'first': move to the first neighbor that improves the likelihood. 'stochastic': same, visiting neighbors in random order. With MPI, 'first' and 'stochastic' need -X 3")
+    parser.add_argument("--starts", type=is_positive, default=1, help="MPI only: run this many searches at once on separate groups of processes, from --start and then random trees, sharing one likelihood cache")
+    parser.add_argument("--speculate", action="store_true", help="Strategy 1 only: idle ranks start on the neighbors of the best tree so far before the iteration is over")
+    parser.add_argument("-X", "--mpi_method", type=str, help="Pick parallelization strategy: 1 (static split), 2 (decentralized), or 3 (dynamic queue)", default="1")
     parser.add_argument("-l", "--logging", choices=["DEBUG", "INFO", "WARNING", "ERROR","CRITICAL"], default="INFO", help="Set the logging level")
     return parser
 
@@ -58,6 +106,11 @@ def main():
         parser.print_help()
         exit(1)
     logging.basicConfig(level=args.logging)
+    ts.BASEML_EXECUTABLE = args.baseml
+    if args.MPI > 1 and args.climb != "best" and args.mpi_method != "3":
+        parser.error(f"--climb {args.climb} needs the dynamic queue (-X 3) when running with MPI")
+    if args.redispatch and (args.MPI <= 1 or args.mpi_method != "3"):
+        parser.error("--redispatch needs the dynamic queue (-X 3)")
     if args.MPI > 1:
         logging.info(f"Running MPI with {args.MPI} processes")
         # kinda janky, should probably not even do that
@@ -68,18 +121,51 @@ def main():
             "-s", str(args.seq.absolute()),
             "-o", str(args.output.absolute()),
             "-M", str(args.max_iter),
+            "-D", str(args.distance),
+            "-B", args.baseml,
             "-X", str(args.mpi_method),
+            "-j", str(args.jobs),
+            "--cleanup", args.cleanup,
+            "--climb", args.climb,
+            "--shifts", str(args.shifts),
+            "--batch", str(args.batch),
+            "--run_retries", str(args.run_retries),
+            "--redispatch", str(args.redispatch),
+            "--starts", str(args.starts),
+            "--screen", str(args.screen),
+            "--screen_margin", str(args.screen_margin),
             "-l", str(args.logging)
         ]
         if args.seed:
             proc_args.extend(["-z", str(args.seed)])
+        if args.cache:
+            proc_args.extend(["-c", str(args.cache.absolute()), "--cache_size", str(args.cache_size)])
+        if args.resume:
+            proc_args.append("-r")
+        if args.scratch:
+            proc_args.extend(["--scratch", str(args.scratch.absolute())])
+        if args.warm_start:
+            proc_args.append("--warm_start")
+        if args.run_timeout is not None:
+            proc_args.extend(["--run_timeout", str(args.run_timeout)])
+        if args.speculate:
+            proc_args.append("--speculate")
+        if args.profile:
+            proc_args.append("--profile")
+        if args.trace:
+            proc_args.extend(["--trace", str(args.trace.absolute())])
         if args.start:
             proc_args.extend(["-S", str(args.start)])
         subprocess.Popen(proc_args, cwd=Path(__file__).parent).wait()
         # raise NotImplementedError("MPI not yet implemented")
     else:
         logging.info(f"Running serial algorithm")
+        trace.tracer.configure(args.profile, keep_events=args.trace is not None)
         result = ts.serial_single_shift_search(args)
+        if args.profile:
+            print(trace.summary([trace.tracer.state()]))
+        if args.trace:
+            trace.write_chrome_trace(args.trace, [trace.tracer.state()])
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,64 @@
+from io import StringIO
+
+import treesearch as ts
+from benchmarks import fake_baseml
+from utils import baseml
+
+HEADER = "BASEML (in paml version 4.9j)  sequence_TRUE.phy  HKY85 dGamma (ncatG=5)\n\n"
+NEWICKS = [
+    "((A#1,B#1)#1,(C#2,D#2)#2,E#1);",
+    "((A#1,C#1)#1,(B#1,D#1)#2,E#1);",
+    "((A#1,B#2)#1,(C#1,D#1)#1,E#1);",
+]
+
+def multi_tree_result(newicks):
+    fo = StringIO()
+    fo.write(HEADER)
+    for number, newick in enumerate(newicks, start=1):
+        fake_baseml.fake_result(fo, number, newick, {}, "alignment")
+    return fo.getvalue()
+
+def test_split_baseml_result_one_section_per_tree():
+    text = multi_tree_result(NEWICKS)
+    sections = baseml.split_baseml_result(text)
+    assert len(sections) == len(NEWICKS)
+    whole = list(baseml.baseml_log_likelihoods(StringIO(text)))
+    for section, newick, log_likelihood in zip(sections, NEWICKS, whole):
+        # every piece reads like the RESULT of a run with just that tree
+        assert section.startswith(HEADER)
+        assert section.count("TREE #") == 1
+        assert newick in section
+        assert list(baseml.baseml_log_likelihoods(StringIO(section))) == [log_likelihood]
+
+def test_split_baseml_result_unfinished(tmp_path):
+    # what a killed run leaves behind: the last tree started but has no result
+    text = multi_tree_result(NEWICKS[:2]) + f"TREE #  3:  {NEWICKS[2]}\n"
+    result_path = tmp_path / "RESULT"
+    assert ts.trees_started(result_path) == 0
+    result_path.write_text(text)
+    assert ts.trees_started(result_path) == 3
+    sections = baseml.split_baseml_result(text)
+    assert len(sections) == 3
+    assert baseml.best_baseml_result(StringIO(sections[2]))["log likelihood"] == float('-inf')
+
+def test_split_baseml_result_no_trees():
+    assert baseml.split_baseml_result(HEADER) == []
+
+def test_batch_sizer_fits_startup():
+    sizer = ts.BatchSizer(64, overhead=0.1)
+    # 2s startup, 0.1s per tree: startup stays under 10% from 180 trees on
+    for n in (1, 2, 4, 8):
+        sizer.record("single_shift", n, 2 + 0.1 * n)
+    assert sizer.size("single_shift") == 64
+    # no startup to speak of, no point batching
+    for n in (1, 2, 4, 8):
+        sizer.record("screen", n, 0.001 + 0.1 * n)
+    assert sizer.size("screen") == 1
+
+def test_batch_sizer_grows_until_it_can_fit():
+    sizer = ts.BatchSizer(16)
+    assert sizer.size("screen") == 1
+    sizer.record("screen", 1, 1.0)
+    assert sizer.size("screen") == 2
+    # each kind of run is sized on its own
+    assert sizer.size("single_shift") == 1
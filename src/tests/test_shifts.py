@@ -0,0 +1,35 @@
+import math
+
+import ete3
+import pytest
+
+import treesearch as ts
+
+def unrooted_tree(n):
+    tree = ete3.Tree()
+    tree.populate(n, names_library=[f"T{i}" for i in range(n)], random_branches=True)
+    tree.unroot()
+    return tree
+
+@pytest.mark.parametrize("n", [4, 5, 8])
+@pytest.mark.parametrize("k", [1, 2, 3])
+def test_shift_partitions_count(n, k):
+    tree = unrooted_tree(n)
+    partitions = list(ts.get_shift_partitions(tree, k))
+    assert len(partitions) == math.comb(2 * n - 3, k)
+    assert ts.count_shift_partitions(tree, k) == len(partitions)
+    assert all(len(partition) == k + 1 for partition in partitions)
+
+@pytest.mark.parametrize("k", [1, 2])
+def test_bifurcating_root_counts_once(k):
+    # the root's two branches are one branch of the unrooted tree
+    tree = ete3.Tree("((A,B),((C,D),(E,F)));")
+    assert len(list(ts.get_shift_partitions(tree, k))) == math.comb(2 * 6 - 3, k)
+
+@pytest.mark.parametrize("k", [1, 2, 3])
+def test_shift_assignments_are_distinct(k):
+    n = 7
+    assignments = list(ts.shift_assignments(unrooted_tree(n), k))
+    assert len(assignments) == math.comb(2 * n - 3, k)
+    # no two are the same placement with the models named differently
+    assert len({ts.labelled_topology_key(newick) for newick in assignments}) == len(assignments)
@@ -0,0 +1,61 @@
+import ete3
+import pytest
+
+import treesearch as ts
+
+def unrooted_tree(n):
+    tree = ete3.Tree()
+    tree.populate(n, names_library=[f"T{i}" for i in range(n)], random_branches=True)
+    tree.unroot()
+    return tree
+
+@pytest.mark.parametrize("n", [4, 5, 8, 20])
+def test_nni_move_keys_match_their_trees(n):
+    tree = unrooted_tree(n)
+    index = ts.taxon_index(tree)
+    moves = list(ts.nni_moves(tree, index))
+    assert len(moves) == 2 * (n - 3)
+    for key, move in moves:
+        assert ts.topology_key(ts.nni_tree(tree, move), index) == key
+
+@pytest.mark.parametrize("n", [4, 5, 8, 20])
+def test_nni_moves_match_biopython(n):
+    tree = unrooted_tree(n)
+    index = ts.taxon_index(tree)
+    keys = [key for key, _ in ts.nni_moves(tree, index)]
+    old_keys = {ts.topology_key(t, index) for t in ts.biopython_nearest_neighbors(tree.copy())}
+    assert len(set(keys)) == len(keys)
+    assert set(keys) == old_keys
+    assert ts.topology_key(tree, index) not in old_keys
+
+@pytest.mark.parametrize("n", [5, 8])
+def test_topology_key_ignores_root(n):
+    tree = unrooted_tree(n)
+    index = ts.taxon_index(tree)
+    key = ts.topology_key(tree, index)
+    for node in tree.iter_descendants():
+        rerooted = tree.copy()
+        leaves = node.get_leaf_names()
+        rerooted.set_outgroup(rerooted & leaves[0] if node.is_leaf() else rerooted.get_common_ancestor(leaves))
+        # rooted on a branch, then back to a trifurcation somewhere else
+        assert ts.topology_key(rerooted, index) == key
+        rerooted.unroot()
+        assert ts.topology_key(rerooted, index) == key
+
+def test_topology_key_tells_topologies_apart():
+    a = ete3.Tree("((A,B),(C,D),E);")
+    b = ete3.Tree("((A,C),(B,D),E);")
+    index = ts.taxon_index(a)
+    assert ts.topology_key(a, index) != ts.topology_key(b, index)
+
+def test_labelled_key_ignores_model_numbering():
+    swapped = "((A#2,B#2)#2,(C#1,D#1)#1,E#2)#2;"
+    original = "((A#1,B#1)#1,(C#2,D#2)#2,E#1)#1;"
+    assert ts.labelled_topology_key(original) == ts.labelled_topology_key(swapped)
+    # and the order the subtrees were written in
+    assert ts.labelled_topology_key(original) == ts.labelled_topology_key("(E#1,(D#2,C#2)#2,(B#1,A#1)#1)#1;")
+
+def test_labelled_key_tells_placements_apart():
+    shift_above_cd = "((A#1,B#1)#1,(C#2,D#2)#2,E#1)#1;"
+    shift_above_ab = "((A#2,B#2)#2,(C#1,D#1)#1,E#1)#1;"
+    assert ts.labelled_topology_key(shift_above_cd) != ts.labelled_topology_key(shift_above_ab)
@@ -1,14 +1,29 @@
 from pathlib import Path
 from Bio import AlignIO, Phylo
-from Bio.Phylo.TreeConstruction import NNITreeSearcher, DistanceCalculator, DistanceTreeConstructor
+from Bio.Phylo.TreeConstruction import NNITreeSearcher
 from io import StringIO
 import numpy as np
 
 import random
+import re
+import math
+import itertools
 import ete3
+import logging
 import subprocess
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 
-from utils import baseml
+from utils import baseml, distance, trace
+from utils.archive import RunArchive
+from utils.cache import LikelihoodCache
+from utils.checkpoint import Checkpointer
+from utils.workspace import Workspace, remove_path
+
+# what run_baseml launches, the drivers set this from --baseml
+BASEML_EXECUTABLE = "baseml"
 
 def fill_baseml_template(ctl_template, replacements):
     result = ctl_template
@@ -16,8 +31,16 @@ def fill_baseml_template(ctl_template, replacements):
         result = result.replace(this, with_this)
     return result
 
-def nearest_neighbors(ete3tree, is_unrooted=True):
-    #ete3tree = ete3.Tree(tree_string)
+def set_control_option(ctl_template, option, value):
+    # swaps the value of "option = x" in a control file (or adds the line)
+    pattern = re.compile(rf"^(\s*{option}\s*=\s*)\S+", re.MULTILINE)
+    if pattern.search(ctl_template):
+        return pattern.sub(rf"\g<1>{value}", ctl_template, count=1)
+    return ctl_template + f"\n{option} = {value}\n"
+
+def biopython_nearest_neighbors(ete3tree, is_unrooted=True):
+    # the old way, round-tripping through Biopython's NNI. kept around for
+    # rooted trees and to benchmark against
     if is_unrooted:
         ete3tree.resolve_polytomy()
     bio_tree = Phylo.read(StringIO(ete3tree.write(format=9)),format='newick')
@@ -28,6 +51,25 @@ def nearest_neighbors(ete3tree, is_unrooted=True):
             t.unroot()
     return all_neighbors
 
+def nearest_neighbors(ete3tree, is_unrooted=True):
+    if not is_unrooted:
+        return biopython_nearest_neighbors(ete3tree, is_unrooted)
+    return [nni_tree(ete3tree, move) for _, move in nni_moves(ete3tree)]
+
+def unvisited_neighbors(tree, visited_keys, index=None):
+    """
+    NNI neighbors of tree that aren't in visited_keys, as (key, tree)
+    pairs, and how many were skipped. Skipped neighbors never get built.
+    """
+    neighbors = []
+    n_skipped = 0
+    for key, move in nni_moves(tree, index):
+        if key in visited_keys:
+            n_skipped += 1
+        else:
+            neighbors.append((key, nni_tree(tree, move)))
+    return neighbors, n_skipped
+
 def random_tree(alignment, unroot=True):
     tree = ete3.Tree()
     taxa = [x.name for x in alignment]
@@ -36,15 +78,30 @@ def random_tree(alignment, unroot=True):
         tree.unroot()
     return tree
 
-def nj_tree(alignment, unrooted=True):
-    calculator = DistanceCalculator('identity')
-    constructor = DistanceTreeConstructor(calculator, 'nj')
-    bio_tree = constructor.build_tree(alignment)
-    result = ete3.Tree(bio_tree.format('newick').replace('Inner', ''))
+def nj_tree(alignment, unrooted=True, model='identity'):
+    result = distance.neighbor_joining(*distance.distance_matrix(alignment, model))
+    if not unrooted:
+        # NJ trees come out unrooted, root on the first taxon like DistanceTreeConstructor did
+        result.set_outgroup(result.get_leaves()[0])
+    return result
+
+def upgma_tree(alignment, unrooted=True, model='identity'):
+    result = distance.upgma(*distance.distance_matrix(alignment, model))
     if unrooted:
         result.unroot()
     return result
 
+def starting_tree(args):
+    alignment = AlignIO.read(args.seq, format='phylip-relaxed')
+    if args.start == 'nj':
+        return nj_tree(alignment, model=args.distance)
+    elif args.start == 'upgma':
+        return upgma_tree(alignment, model=args.distance)
+    elif args.start == 'random':
+        return random_tree(alignment)
+    else:
+        raise NotImplementedError(f"{args.start} strategy not implemented :(")
+
 def best_result(results):
     best_result = {'log likelihood' : float('-inf')}
     best_log_likelihood = float('-inf')
@@ -55,21 +112,56 @@ def best_result(results):
                 best_result = result
     return best_result
 
-def get_shift_partitions(tree, k=1):
-    # So far I've only implemented this for bipartitions (k=1 shifts)
-    # I believe all the ways you can choose k nodes tells you how
-    assert k==1
-    sps = set()
-    nodeset = set(tree.traverse())
-    for node in tree.traverse():
+def batched(iterable, n):
+    # itertools.batched, which needs python 3.12
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, n)):
+        yield batch
+
+def shift_branches(tree):
+    # the node below each branch of the unrooted tree, in preorder. A
+    # bifurcating root's two branches are one unrooted branch, so only the
+    # first of them counts
+    index = taxon_index(tree)
+    full_mask = (1 << len(index)) - 1
+    masks = split_masks(tree, index)
+    seen = set()
+    branches = []
+    for node in tree.traverse("preorder"):
         if node.is_root():
             continue
-        p1 = set(node.get_descendants())
-        p1.add(node)
-        p1 = frozenset(p1)
-        p2 = frozenset(nodeset - p1)
-        sps.add(frozenset((p1,p2)))
-    return sps
+        bp = bipartition_mask(masks[node], full_mask)
+        if bp not in seen:
+            seen.add(bp)
+            branches.append(node)
+    return branches
+
+def count_shift_partitions(tree, k=1):
+    return math.comb(len(shift_branches(tree)), k)
+
+def get_shift_partitions(tree, k=1):
+    """
+    Every way to put k model shifts on tree's branches, lazily (there are
+    C(2n-3, k) of them). Each is a list of k+1 lists of nodes, one per
+    model: the root's first, then the ones below each shift in preorder.
+
+    Each set of branches comes up once and the models are always numbered
+    that way, so placements that only differ by which model is called
+    what, or by a bifurcating root, are never produced twice.
+    """
+    order = list(tree.traverse("preorder"))
+    for shifted in itertools.combinations(shift_branches(tree), k):
+        shifted = set(shifted)
+        model = {}
+        partition = [[]]
+        for node in order:
+            if node in shifted:
+                model[node] = len(partition)
+                partition.append([])
+            else:
+                model[node] = 0 if node.is_root() else model[node.up]
+            partition[model[node]].append(node)
+        yield partition
 
 def bipartition_key(node, all_leaves):
     leaves = {x.name for x in node.get_leaves()}
@@ -82,135 +174,801 @@ def bipartition_representation(tree):
     all_leaves = {x.name for x in tree.get_leaves()}
     return frozenset({bipartition_key(x, all_leaves) for x in  tree.traverse()})
 
-def single_shift_assignments(input_tree):
+# Same idea as bipartition_representation, but with each side of a bipartition
+# packed into an int (bit i set <=> taxon i on that side) so it's cheap to
+# build, hash and compare. Taxa are indexed in sorted order so the key doesn't
+# depend on how the tree happens to be rooted or ordered.
+def taxon_index(tree):
+    return {name : i for i, name in enumerate(sorted(tree.get_leaf_names()))}
+
+def split_masks(tree, index):
+    # leaf bitmask below every node, one postorder pass
+    masks = {}
+    for node in tree.traverse("postorder"):
+        if node.is_leaf():
+            masks[node] = 1 << index[node.name]
+        else:
+            mask = 0
+            for child in node.children:
+                mask |= masks[child]
+            masks[node] = mask
+    return masks
+
+def bipartition_mask(mask, full_mask):
+    # a bipartition is always written as the side that doesn't contain taxon 0
+    if mask & 1:
+        return full_mask ^ mask
+    return mask
+
+def topology_key(tree, index=None):
+    """
+    Hashable key for an unrooted topology: the sorted tuple of its
+    nontrivial bipartitions as bitmasks. Two trees on the same taxa have
+    the same key iff their RF distance is 0.
+    """
+    if index is None:
+        index = taxon_index(tree)
+    full_mask = (1 << len(index)) - 1
+    splits = set()
+    for mask in split_masks(tree, index).values():
+        bp = bipartition_mask(mask, full_mask)
+        # skip the trivial ones (empty side or a single leaf), every tree has those
+        if bp & (bp - 1):
+            splits.add(bp)
+    return tuple(sorted(splits))
+
+def labelled_topology_key(newick):
+    """
+    Canonical string for a tree carrying baseml model labels (name#k), like
+    the ones from single_shift_assignments. Every branch is written as its
+    bipartition plus the label of the node below it, and labels are
+    renumbered in order of first appearance, so the same shift placement
+    gets the same key however the tree is ordered and whichever side
+    happened to be called #1.
+    """
+    # format 1 reads the labels with or without branch lengths
+    tree = ete3.Tree(newick, format=1)
+    labels = {}
+    for node in tree.traverse():
+        node.name, _, labels[node] = node.name.partition('#')
+    index = taxon_index(tree)
+    full_mask = (1 << len(index)) - 1
+    masks = split_masks(tree, index)
+    branches = sorted(
+        (bipartition_mask(masks[node], full_mask), labels[node])
+        for node in tree.traverse() if not node.is_root()
+    )
+    renumber = {}
+    for label in [labels[tree]] + [label for _, label in branches]:
+        if label not in renumber:
+            renumber[label] = len(renumber) + 1
+    branch_str = ",".join(f"{mask:x}#{renumber[label]}" for mask, label in branches)
+    return f"{branch_str};#{renumber[labels[tree]]}"
+
+def resolve_unrooted(tree):
+    # fully binary, with the usual trifurcation at the root
+    if len(tree.children) > 3 or any(len(n.children) > 2 for n in tree.iter_descendants()):
+        tree.resolve_polytomy()
+    if len(tree.children) == 2:
+        tree.unroot()
+
+def nni_moves(tree, index=None):
+    """
+    Lazily yields (key, move) for each of the 2(n-3) NNI neighbors of an
+    unrooted tree, without building any of them (nni_tree does that).
+
+    Every internal edge is a non-root internal node v and its parent u, and
+    a move swaps one of v's children with one of v's siblings. Only the
+    split on that edge changes, so the neighbor's key is the old one with
+    that single split swapped out.
+    """
+    resolve_unrooted(tree)
+    if index is None:
+        index = taxon_index(tree)
+    full_mask = (1 << len(index)) - 1
+    masks = split_masks(tree, index)
+    splits = set(topology_key(tree, index))
+    for v in tree.iter_descendants():
+        if v.is_leaf():
+            continue
+        siblings = [s for s in v.up.children if s is not v]
+        c, d = v.children
+        if len(siblings) == 2: # v hangs off the root
+            moves = [(c, siblings[0]), (c, siblings[1])]
+        else:
+            moves = [(c, siblings[0]), (d, siblings[0])]
+        old_split = bipartition_mask(masks[v], full_mask)
+        others = splits - {old_split}
+        for x, y in moves:
+            new_split = bipartition_mask(masks[v] ^ masks[x] ^ masks[y], full_mask)
+            yield tuple(sorted(others | {new_split})), (x, y)
+
+def nni_tree(tree, move):
+    # copy of tree with the two subtrees in move swapped. builds the nodes
+    # directly instead of deep-copying or going through newick
+    x, y = move
+    swap = {x : y, y : x}
+    result = ete3.Tree(name=tree.name, dist=tree.dist)
+    stack = [(tree, result)]
+    while stack:
+        node, new_node = stack.pop()
+        for child in node.children:
+            child = swap.get(child, child)
+            stack.append((child, new_node.add_child(name=child.name, dist=child.dist)))
+    return result
+
+def branch_lengths(tree, index=None):
+    # bipartition mask -> branch length, to move lengths onto another copy of the topology
+    if index is None:
+        index = taxon_index(tree)
+    full_mask = (1 << len(index)) - 1
+    masks = split_masks(tree, index)
+    return {bipartition_mask(masks[node], full_mask) : node.dist for node in tree.traverse() if not node.is_root()}
+
+def warm_start_lengths(tree):
+    # starting values for fix_blength = 1, kept off 0 so baseml doesn't start on the boundary
+    return {mask : max(length, 1e-4) for mask, length in branch_lengths(tree).items()}
+
+def shift_assignments(input_tree, k=1, lengths=None):
+    """
+    Generates the newick strings of every way to put k model shifts on the
+    tree (see get_shift_partitions), with baseml model labels (name#k).
+    Given lengths (see branch_lengths) the branch lengths get written out
+    as well. Always in the same order for the same tree.
+    """
     tree = input_tree.copy()
-    shift_partitions = get_shift_partitions(tree)
     for node in tree.traverse():
         node.original_name = node.name
+    tree_format = 8
+    if lengths is not None:
+        index = taxon_index(tree)
+        full_mask = (1 << len(index)) - 1
+        masks = split_masks(tree, index)
+        for node in tree.traverse():
+            if not node.is_root():
+                node.dist = lengths.get(bipartition_mask(masks[node], full_mask), node.dist)
+        tree_format = 1
 
-    model_assignments = []
-    for sp in shift_partitions:
-        for modelnum, nodes in enumerate(sp, start=1):
+    for partition in get_shift_partitions(tree, k):
+        for modelnum, nodes in enumerate(partition, start=1):
             for node in nodes:
-                if node.is_root():
-                    root_name = f"#{modelnum}"
                 node.name = f"{node.original_name}#{modelnum}"
-        model_assignments.append(tree.write(format=8).replace(";",f"{root_name};"))
-    return model_assignments
+        # the root is always in model 1
+        yield tree.write(format=tree_format).replace(";", "#1;")
+
+def single_shift_assignments(input_tree, lengths=None):
+    return list(shift_assignments(input_tree, 1, lengths))
+
+def open_archive(args, rank=0):
+    if args.cleanup != "compress":
+        return None
+    return RunArchive(args.output, rank)
+
+def open_cache(args):
+    if args.cache is None:
+        return None
+    return LikelihoodCache(args.cache, args.seq, max_entries=args.cache_size)
+
+def open_limits(args):
+    if args.run_timeout is None:
+        return None
+    return RunLimits(args.run_timeout, args.run_retries)
+
+class RunLimits:
+    """
+    Wall-time limit on each baseml run (--run_timeout). A run that goes
+    over gets killed and started again from different starting values, up
+    to `retries` times (--run_retries), and after that it scores -inf.
+    Keeps count of both, from any number of threads.
+    """
+    def __init__(self, timeout, retries=0):
+        self.timeout = timeout
+        self.retries = retries
+        self.timeouts = 0
+        self.retried = 0
+        self.lock = threading.Lock()
+
+    def timed_out(self, retrying):
+        with self.lock:
+            self.timeouts += 1
+            self.retried += retrying
+
+    def counts(self):
+        # timed out, retried, gave up
+        with self.lock:
+            return self.timeouts, self.retried, self.timeouts - self.retried
+
+def restart_control(baseml_control, attempt, tree_string):
+    # somewhere else for a retry to start from. With kappa estimated
+    # (fix_kappa = 0) its value in the control file is only the starting point
+    if re.search(r"^\s*fix_kappa\s*=\s*0\b", baseml_control, re.MULTILINE) is None:
+        return baseml_control
+    rng = random.Random(f"{tree_string} {attempt}")
+    return set_control_option(baseml_control, "kappa", f"{rng.uniform(0.5, 10):.4f}")
+
+def wait_baseml(proc, timeout=None):
+    # True if it had to be killed for going over the time limit
+    try:
+        proc.wait(timeout=timeout)
+        return False
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+        return True
+
+def trees_started(result_path):
+    # baseml writes a tree's "TREE #" line to RESULT when it starts on it
+    try:
+        return len(re.findall(r"^TREE #", Path(result_path).read_text(), flags=re.MULTILINE))
+    except FileNotFoundError:
+        return 0
+
+def wait_baseml_batch(proc, result_path, limits=None):
+    """
+    wait_baseml for a run over several trees. Every tree gets the time
+    limit to itself, from when baseml starts on it, same as when they run
+    one per process. Returns None if the run finished, otherwise the
+    index of the tree it got killed on.
+    """
+    if limits is None:
+        proc.wait()
+        return None
+    started = 0
+    deadline = time.monotonic() + limits.timeout
+    while True:
+        try:
+            proc.wait(timeout=0.05)
+            return None
+        except subprocess.TimeoutExpired:
+            pass
+        n_started = trees_started(result_path)
+        if n_started > started:
+            started = n_started
+            deadline = time.monotonic() + limits.timeout
+        elif time.monotonic() > deadline:
+            proc.kill()
+            proc.wait()
+            return max(started, 1) - 1
+
+class Cancelled(Exception):
+    pass
+
+class Cancellation:
+    """
+    Handed to run_baseml / run_single_shift_baseml so another thread can
+    stop them: cancel() kills every baseml process started with it, and
+    runs that haven't started yet raise Cancelled instead of starting.
+    """
+    def __init__(self):
+        self.cancelled = False
+        self.procs = set()
+        self.lock = threading.Lock()
+
+    def start(self, proc_args, **kwargs):
+        with self.lock:
+            if self.cancelled:
+                raise Cancelled()
+            proc = subprocess.Popen(proc_args, **kwargs)
+            self.procs.add(proc)
+        return proc
 
-def run_baseml(tree, output_path, ctl_template, writetree = lambda x : x.write(format=9)):
+    def finished(self, proc):
+        with self.lock:
+            self.procs.discard(proc)
+        if self.cancelled:
+            raise Cancelled()
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            for proc in self.procs:
+                proc.kill()
+
+def launch_baseml(output_path, baseml_control, restart_key, cancel=None, limits=None, first_attempt=0):
+    """
+    Runs baseml in output_path, where baseml.ctl (baseml_control) and its
+    treefile already are, sticking to limits. Retries start from somewhere
+    picked with restart_key, and first_attempt > 0 skips attempts that
+    already happened elsewhere (see run_baseml_batch). Returns False if
+    every attempt timed out.
+    """
+    proc_args = [BASEML_EXECUTABLE, f"baseml.ctl"]
+    attempts = 1 if limits is None else 1 + limits.retries
+    timeout = None if limits is None else limits.timeout
+    for attempt in range(first_attempt, attempts):
+        if attempt > 0:
+            with open(f"{output_path}/baseml.ctl", 'w') as fo:
+                fo.write(restart_control(baseml_control, attempt, restart_key))
+        with trace.phase("baseml"), open(f"{output_path}/LOG", 'w') as fo:
+            if cancel is None:
+                baseml_proc = subprocess.Popen(proc_args, cwd=output_path, stdout=fo)
+                timed_out = wait_baseml(baseml_proc, timeout)
+            else:
+                baseml_proc = cancel.start(proc_args, cwd=output_path, stdout=fo)
+                timed_out = wait_baseml(baseml_proc, timeout)
+                cancel.finished(baseml_proc)
+        if not timed_out:
+            return True
+        limits.timed_out(retrying=attempt + 1 < attempts)
+        logging.info(f"baseml went over {timeout}s in {output_path} (attempt {attempt + 1} of {attempts})")
+    logging.warning(f"Giving up on {output_path}, every baseml attempt timed out")
+    return False
+
+def run_baseml(tree, output_path, ctl_template, writetree = lambda x : x.write(format=9), cache=None, cancel=None, limits=None, first_attempt=0):
     control_path = Path(f"{output_path}/baseml.ctl")
     result_path = Path(f"{output_path}/RESULT")
     tree_path = Path(f"{output_path}/tree")
-    log_path = Path(f"{output_path}/LOG")
     replacements = [
         ("#TREEFILE",  tree_path.name),
         ("#OUTPUTFILE", result_path.name),
     ]
     baseml_control = fill_baseml_template(ctl_template, replacements)
-    with open(tree_path, 'w') as fo:
-        fo.write(f"{len(tree)} 1\n")
-        fo.write(writetree(tree))
-        fo.write('\n')
-    with open(control_path, 'w') as fo:
-        fo.write(baseml_control)
-
-    proc_args = ["baseml", f"baseml.ctl"]
-    with open(log_path, 'w') as fo:
-        baseml_proc = subprocess.Popen(proc_args, cwd=output_path, stdout=fo)
-        baseml_proc.wait()
+    tree_string = writetree(tree)
+    with trace.phase("write inputs"):
+        with open(tree_path, 'w') as fo:
+            fo.write(f"{len(tree)} 1\n")
+            fo.write(tree_string)
+            fo.write('\n')
+        with open(control_path, 'w') as fo:
+            fo.write(baseml_control)
+
+    if cache is not None:
+        with trace.phase("cache lookup"):
+            cache_key = labelled_topology_key(tree_string)
+            cached = cache.get(baseml_control, cache_key)
+        if cached is not None:
+            result, raw = cached
+            # leave a RESULT behind so the directory looks like any other run
+            with open(result_path, 'w') as fo:
+                fo.write(raw)
+            return result
+
+    if not launch_baseml(output_path, baseml_control, tree_string, cancel=cancel, limits=limits, first_attempt=first_attempt):
+        return {"log likelihood" : float('-inf')}
     # print(result_path)
-    result = best_result(baseml.parse_baseml_result(result_path))
+    with trace.phase("parse"):
+        result = baseml.best_baseml_result(result_path)
+    if cache is not None and result["log likelihood"] > float('-inf'):
+        with trace.phase("cache store"):
+            cache.put(baseml_control, cache_key, result, result_path.read_text())
     return result
 
-def run_single_shift_baseml(tree, output_path, ctl_template, cleanup="delete"):
-    model_assignments = single_shift_assignments(tree)
+def open_batcher(args):
+    if args.batch <= 1:
+        return None
+    return BatchSizer(args.batch)
+
+class BatchSizer:
+    """
+    How many trees go into one baseml run (--batch). Every run costs
+    startup (reading the control file and the alignment) plus some time
+    per tree, so this fits seconds = startup + trees * per_tree to the
+    recent runs and picks the smallest batch that keeps startup under
+    `overhead` of the run, up to max_size. Until there are runs of two
+    different sizes to fit, it tries bigger ones. Shared by threads.
+
+    Runs from different control files (the screening runs with branch
+    lengths fixed and the full ones) take very different times per tree,
+    so each kind, e.g. the run prefix, gets a fit of its own.
+    """
+    def __init__(self, max_size, overhead=0.1):
+        self.max_size = max_size
+        self.overhead = overhead
+        self.runs = defaultdict(lambda: deque(maxlen=64))
+        self.lock = threading.Lock()
+
+    def record(self, kind, n_trees, seconds):
+        with self.lock:
+            self.runs[kind].append((n_trees, seconds))
+
+    def size(self, kind):
+        with self.lock:
+            runs = list(self.runs[kind])
+        sizes = {n for n, _ in runs}
+        if len(sizes) < 2:
+            return min(2 * max(sizes, default=0) or 1, self.max_size)
+        per_tree, startup = np.polyfit(*zip(*runs), 1)
+        if per_tree <= 0:
+            return self.max_size
+        if startup <= 0:
+            return 1
+        size = math.ceil(startup * (1 - self.overhead) / (self.overhead * per_tree))
+        return max(1, min(size, self.max_size))
+
+def run_baseml_batch(tree, candidates, run_path, ctl_template, prefix, cache=None, cancel=None, limits=None, batcher=None):
+    """
+    Runs baseml once on several (index, model tree) candidates for tree,
+    all in one treefile, and splits the RESULT back up so every candidate
+    gets a run_path(f"{prefix}_{index}") directory with its own tree and
+    RESULT, same as if it had been run by itself. Cached candidates don't
+    go in the treefile. Returns (index, path, result) for each, in order,
+    and tells batcher how long baseml took.
+    """
+    # the same control file every candidate would get on its own, which is
+    # also what the cache knows them by
+    baseml_control = fill_baseml_template(ctl_template, [("#TREEFILE", "tree"), ("#OUTPUTFILE", "RESULT")])
+    runs = {}
+    todo = []
+    for ix, model_tree in candidates:
+        path = run_path(f"{prefix}_{ix}")
+        with open(f"{path}/tree", 'w') as fo:
+            fo.write(f"{len(tree)} 1\n{model_tree}\n")
+        if cache is not None:
+            with trace.phase("cache lookup"):
+                cached = cache.get(baseml_control, labelled_topology_key(model_tree))
+            if cached is not None:
+                result, raw = cached
+                with open(f"{path}/RESULT", 'w') as fo:
+                    fo.write(raw)
+                runs[ix] = (ix, path, result)
+                continue
+        todo.append((ix, path, model_tree))
+    if not todo:
+        return [runs[ix] for ix, _ in candidates]
+
+    batch_path = run_path(f"{prefix}_batch_{todo[0][0]}")
+    with trace.phase("write inputs"):
+        with open(f"{batch_path}/tree", 'w') as fo:
+            fo.write(f"{len(tree)} {len(todo)}\n")
+            for _, _, model_tree in todo:
+                fo.write(f"{model_tree}\n")
+        with open(f"{batch_path}/baseml.ctl", 'w') as fo:
+            fo.write(baseml_control)
+    result_path = Path(f"{batch_path}/RESULT")
+    tic = time.perf_counter()
+    with trace.phase("baseml"), open(f"{batch_path}/LOG", 'w') as fo:
+        proc_args = [BASEML_EXECUTABLE, f"baseml.ctl"]
+        if cancel is None:
+            baseml_proc = subprocess.Popen(proc_args, cwd=batch_path, stdout=fo)
+        else:
+            baseml_proc = cancel.start(proc_args, cwd=batch_path, stdout=fo)
+        killed_at = wait_baseml_batch(baseml_proc, result_path, limits)
+        if cancel is not None:
+            cancel.finished(baseml_proc)
+    sections = baseml.split_baseml_result(result_path.read_text()) if result_path.is_file() else []
+    if killed_at is None:
+        if batcher is not None:
+            batcher.record(prefix, len(todo), time.perf_counter() - tic)
+    else:
+        # the trees before killed_at finished, the one it was on counts as a
+        # timed out attempt, and neither it nor the rest have a result yet
+        sections = sections[:killed_at]
+        limits.timed_out(retrying=limits.retries > 0)
+        logging.info(f"baseml timed out in {batch_path} on tree {killed_at + 1} of {len(todo)}")
+    for i, (ix, path, model_tree) in enumerate(todo):
+        if i >= len(sections):
+            # baseml died or got killed before finishing this one, so it gets
+            # a run (and time limit) of its own
+            runs[ix] = (ix, path, run_baseml(tree, path, ctl_template, writetree=lambda x, t=model_tree: t,
+                                             cache=cache, cancel=cancel, limits=limits,
+                                             first_attempt=1 if i == killed_at else 0))
+            continue
+        raw = sections[i]
+        with trace.phase("parse"):
+            with open(f"{path}/RESULT", 'w') as fo:
+                fo.write(raw)
+            result = baseml.best_baseml_result(StringIO(raw))
+        if cache is not None and result["log likelihood"] > float('-inf'):
+            with trace.phase("cache store"):
+                cache.put(baseml_control, labelled_topology_key(model_tree), result, raw)
+        runs[ix] = (ix, path, result)
+    remove_path(batch_path)
+    return [runs[ix] for ix, _ in candidates]
+
+def run_candidates(pool, jobs, tree, candidates, run_path, ctl_template, prefix, cache=None, cancel=None, limits=None, batcher=None):
+    """
+    Runs a list of (index, model tree) candidates for tree through pool,
+    each in run_path(f"{prefix}_{index}"), and returns (index, path, result)
+    in the same order. One baseml process per candidate, or with a batcher
+    as many per process as it says, but never so many that some of the
+    `jobs` threads are left with nothing.
+    """
+    if batcher is None:
+        def run_one(candidate):
+            ix, model_tree = candidate
+            path = run_path(f"{prefix}_{ix}")
+            return ix, path, run_baseml(tree, path, ctl_template, writetree = lambda x : model_tree, cache=cache, cancel=cancel, limits=limits)
+        return list(pool.map(run_one, candidates))
+    size = min(batcher.size(prefix), math.ceil(len(candidates) / jobs))
+    def run_batch(batch):
+        return run_baseml_batch(tree, batch, run_path, ctl_template, prefix, cache=cache, cancel=cancel, limits=limits, batcher=batcher)
+    return [run for runs in pool.map(run_batch, batched(candidates, size)) for run in runs]
+
+def screen_single_shift(tree, run_path, ctl_template, top_k, margin=0.0, shifts=1, jobs=1, cache=None, cancel=None, limits=None, batcher=None):
+    """
+    Cheap first pass for run_single_shift_baseml. tree gets fitted once
+    without a shift, then every shift assignment is scored with its
+    branch lengths fixed to that fit (fix_blength = 2), so baseml only has
+    to optimize the substitution parameters. run_path(name) gives the
+    directory for a run.
+
+    Returns (index from 1, assignment) for the top_k assignments plus any
+    scoring within margin of the best, in index order. The assignments are
+    written with the fitted branch lengths, which a full run with
+    fix_blength = 0 ignores. Scoring goes a batch at a time and only the
+    ones still in the running are kept, so shifts > 1 never has every
+    assignment around at once.
+    """
+    homogeneous = run_baseml(tree, run_path("homogeneous"), ctl_template, cache=cache, cancel=cancel, limits=limits)
+    if homogeneous["log likelihood"] == float('-inf'):
+        logging.warning("Homogeneous fit failed, not screening shift placements")
+        return enumerate(shift_assignments(tree, shifts), start=1)
+    assignments = shift_assignments(tree, shifts, branch_lengths(homogeneous["tree"]))
+    screen_ctl = set_control_option(ctl_template, "fix_blength", 2)
+    kept = [] # (score, index, assignment), best first
+    n_scored = 0
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        for chunk in batched(enumerate(assignments, start=1), SHIFT_BATCH * jobs):
+            # screening scores aren't real likelihoods, so they stay out of the cache
+            runs = run_candidates(pool, jobs, tree, chunk, run_path, screen_ctl, "screen", cancel=cancel, limits=limits, batcher=batcher)
+            for (_, path, result), (ix, model_tree) in zip(runs, chunk):
+                remove_path(path)
+                kept.append((result["log likelihood"], ix, model_tree))
+            n_scored += len(chunk)
+            # sort is stable, so ties keep going to the lower index
+            kept.sort(key=lambda x : -x[0])
+            cutoff = kept[0][0] - margin
+            kept = kept[:top_k] + [x for x in kept[top_k:] if x[0] >= cutoff]
+    logging.debug(f"Screening kept {len(kept)} of {n_scored} shift placements")
+    return sorted((ix, model_tree) for _, ix, model_tree in kept)
+
+# how many assignments go through the pool at a time, per job
+SHIFT_BATCH = 32
+
+def run_single_shift_baseml(tree, output_path, ctl_template, cleanup="delete", jobs=1, cache=None, workspace=None, archive=None, screen=0, screen_margin=0.0, warm_start=False, cancel=None, shifts=1, limits=None, batcher=None):
+    """
+    Runs baseml on every assignment of shifts model shifts (one by
+    default) to tree and returns the best result. With a workspace the
+    runs go in its scratch slots and nothing is written under output_path:
+    the result's "Path" is the winning slot, which the next call reuses,
+    so hand it to workspace.keep if it's worth keeping.
+
+    The assignments are generated as they're needed and go through the
+    `jobs` threads SHIFT_BATCH * jobs at a time. With shifts > 1 there are
+    C(2n-3, shifts) of them, so then the losing runs of each batch are
+    removed as soon as it's done instead of at the end.
+
+    With cleanup="compress" every run (winner included) is also handed to
+    archive, a RunArchive, under the step name output_path.name, before
+    the losers are deleted.
+    cleanup="keep" (not a command line choice) leaves every run under
+    output_path when there's no workspace, apart from the losers pruned
+    with shifts > 1; benchmarks/screen.py counts them that way.
+
+    screen > 0 only fully optimizes the assignments that come out of
+    screen_single_shift (top screen, plus any within screen_margin).
+    0 runs all of them.
+
+    warm_start starts baseml from branch lengths instead of from scratch
+    (fix_blength = 1): the ones on tree, which for a neighbor are its
+    parent's estimates, or the homogeneous fit's when screening.
+
+    cancel is a Cancellation: if it gets cancelled, the runs still going
+    are killed and this raises Cancelled.
+
+    batcher is a BatchSizer: with one, several assignments go through each
+    baseml process (see run_baseml_batch).
+
+    limits is a RunLimits, see run_baseml. If every run failed or timed
+    out, the result has a log likelihood of -inf, the same tree and a
+    "Path" of None.
+    """
     best_info = None
     best_likelihood = float('-inf')
-    output_path.mkdir(parents=True, exist_ok=True)
-    for ix, model_tree in enumerate(model_assignments, start=1):
-        sub_path = Path(f"{output_path}/single_shift_{ix}")
-        sub_path.mkdir(exist_ok=True)
-        result = run_baseml(tree, sub_path, ctl_template, writetree = lambda x : model_tree)
-        if best_likelihood < result["log likelihood"]:
-            best_info = result
-            best_info["Path"] = sub_path
-            best_likelihood = result["log likelihood"]
-    if cleanup == "delete":
-        for p in output_path.iterdir():
-            if p != best_info["Path"]:
-                subprocess.run(["rm", "-rf", p.absolute()])
-    #elif cleanup == "compress":
+    if workspace is None:
+        output_path.mkdir(parents=True, exist_ok=True)
+    def run_path(name):
+        if workspace is None:
+            path = Path(f"{output_path}/{name}")
+            path.mkdir(exist_ok=True)
+            return path
+        return workspace.slot(name)
+    if screen:
+        with trace.phase("screen"):
+            candidates = screen_single_shift(tree, run_path, ctl_template, screen, screen_margin, shifts=shifts, jobs=jobs, cache=cache, cancel=cancel, limits=limits, batcher=batcher)
+    else:
+        lengths = warm_start_lengths(tree) if warm_start else None
+        candidates = enumerate(shift_assignments(tree, shifts, lengths), start=1)
+    if warm_start:
+        ctl_template = set_control_option(ctl_template, "fix_blength", 1)
+    prune = shifts > 1
+    # each baseml process is its own thread, so threads are enough to keep
+    # `jobs` of them running at once. Runs come back in the original order so
+    # ties are broken the same way as the serial loop
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        for chunk in batched(candidates, SHIFT_BATCH * jobs):
+            runs = run_candidates(pool, jobs, tree, chunk, run_path, ctl_template, "single_shift", cache=cache, cancel=cancel, limits=limits, batcher=batcher)
+            losers = []
+            for _, sub_path, result in runs:
+                if best_likelihood < result["log likelihood"]:
+                    if best_info is not None:
+                        losers.append(best_info["Path"])
+                    best_info = result
+                    best_info["Path"] = sub_path
+                    best_likelihood = result["log likelihood"]
+                else:
+                    losers.append(sub_path)
+            if cleanup == "compress":
+                with trace.phase("archive"):
+                    for ix, sub_path, _ in runs:
+                        archive.add(output_path.name, ix, sub_path)
+            if prune:
+                with trace.phase("cleanup"):
+                    for p in losers:
+                        remove_path(p)
+    if best_info is None:
+        best_info = {"log likelihood" : float('-inf'), "tree" : tree, "Path" : None}
+    if cleanup in ("delete", "compress") and workspace is None:
+        with trace.phase("cleanup"):
+            for p in output_path.iterdir():
+                if p != best_info["Path"]:
+                    remove_path(p)
 
     return best_info
 
+class Evaluator:
+    """
+    Scores trees for a search driver: run_single_shift_baseml with the
+    control template, and everything else it takes, set up once from args
+    (cache, --run_timeout limits, --batch sizer, scratch workspace,
+    archive). close() releases all of it.
+    """
+    def __init__(self, args, rank=0):
+        with open(args.template, 'r') as fi:
+            ctl_template = "".join(fi.read())
+        self.ctl_template = ctl_template.replace("#SEQFILE", str(args.seq.absolute()))
+        self.args = args
+        self.cache = open_cache(args)
+        self.limits = open_limits(args)
+        self.batcher = open_batcher(args)
+        self.workspace = Workspace(args.scratch)
+        self.archive = open_archive(args, rank)
+
+    def __call__(self, tree, output_path, cancel=None):
+        args = self.args
+        return run_single_shift_baseml(
+            tree, output_path, self.ctl_template, cleanup=args.cleanup, jobs=args.jobs,
+            cache=self.cache, workspace=self.workspace, archive=self.archive,
+            screen=args.screen, screen_margin=args.screen_margin, warm_start=args.warm_start,
+            cancel=cancel, shifts=args.shifts, limits=self.limits, batcher=self.batcher
+        )
+
+    def keep(self, result, output_path):
+        # see Workspace.keep
+        return self.workspace.keep(result, output_path)
+
+    def close(self):
+        self.workspace.close()
+        if self.archive is not None:
+            self.archive.close()
+        if self.cache is not None:
+            self.cache.close()
+
 def serial_single_shift_search(args):
     if args.seed: # ehhh... untested. a half measure at best
         random.seed(args.seed)
 
-    with open(args.template, 'r') as fi:
-        ctl_template = "".join(fi.read())
-    ctl_template = ctl_template.replace("#SEQFILE", str(args.seq.absolute()))
-    
-    alignment = AlignIO.read(args.seq, format='phylip-relaxed')
-    if args.start == 'nj':
-        visited_trees = [nj_tree(alignment)]
-    elif args.start == 'random':
-        visited_trees = [random_tree(alignment)]
-    else:
-        raise NotImplementedError(f"{args.starting_tree} strategy not implemented :(")
-    del alignment # was only used to get an initial estimate
-
-    stepnum = 0
-    best_tree = visited_trees[0]
-    opath = Path(f"{args.output}/step_{stepnum}")
-    result = run_single_shift_baseml(best_tree, opath, ctl_template)
-    best_info = result
-    if result:
-        best_likelihood = result["log likelihood"]
-    else:
-        best_likelihood = float('-inf')
-    
+    evaluate = Evaluator(args)
+    checkpoint = Checkpointer(args.output)
+    state = checkpoint.load() if args.resume else None
     # cursed
     ndigits = len(str(args.max_iter))
 
-    print(f"{str(stepnum).zfill(ndigits)}:\t{best_likelihood}")
-    iter_num = 1
+    if state is not None:
+        random.setstate(state["rng"])
+        best_tree = state["best tree"]
+        best_info = state["best info"]
+        best_likelihood = state["best likelihood"]
+        visited_keys = state["visited"]
+        n_skipped = state["skipped"]
+        stepnum = state["step"]
+        iter_num = state["iteration"]
+        center = state["center"]
+        pending = state["pending"]
+        if pending is not None:
+            pending = deque(pending)
+        index = taxon_index(best_tree)
+        print(f"resuming from iteration {iter_num}, step {stepnum}")
+    else:
+        if args.resume:
+            logging.warning(f"No checkpoint found at {checkpoint.path}, starting from scratch")
+        best_tree = starting_tree(args)
+
+        # topologies are tracked by key, so checking a neighbor is a set lookup
+        index = taxon_index(best_tree)
+        visited_keys = {topology_key(best_tree, index)}
+        n_skipped = 0
+
+        stepnum = 0
+        trace.set_iteration(0)
+        opath = Path(f"{args.output}/step_{stepnum}")
+        with trace.phase("evaluate"):
+            result = evaluate(best_tree, opath)
+        best_info = result
+        if result["Path"] is not None:
+            evaluate.keep(result, opath)
+            best_likelihood = result["log likelihood"]
+        else:
+            best_likelihood = float('-inf')
+        print(f"{str(stepnum).zfill(ndigits)}:\t{best_likelihood}")
+        iter_num = 1
+        # center is the tree whose neighborhood is being searched, pending
+        # is what's left of that neighborhood
+        center = None
+        pending = None
+
+    def save_checkpoint():
+        with trace.phase("checkpoint"):
+            checkpoint.save({
+                "rng" : random.getstate(),
+                "best tree" : best_tree,
+                "best info" : best_info,
+                "best likelihood" : best_likelihood,
+                "visited" : visited_keys,
+                "skipped" : n_skipped,
+                "step" : stepnum,
+                "iteration" : iter_num,
+                "center" : center,
+                "pending" : pending
+            })
+
     while iter_num <= args.max_iter:
         # strategy is to visit the neighbors of the highest likelihood tree visited
         # to try different strategies probably change this
-        prev_best_tree = best_tree
-        neighbors = nearest_neighbors(best_tree)
-        for neighbor in neighbors:
-            # Check if this neighbor has been visited already
-            # Maybe there's a faster way of doing this?
-            dont_skip = True
-            for v_tree in visited_trees:
-                if v_tree.compare(neighbor, unrooted=True)["norm_rf"] == 0:
-                    dont_skip = False
-                    break
-            if dont_skip:
-                stepnum += 1
-                opath = Path(f"{args.output}/step_{stepnum}")
-                visited_trees.append(neighbor)
-                result = run_single_shift_baseml(neighbor, opath, ctl_template)
-                if result and result["log likelihood"] > best_likelihood:
-                    best_likelihood = result["log likelihood"]
-                    best_tree = result["tree"]
-                    best_info = result
-                else:
-                    # how to handle suboptimal results
-                    # in this case, just delete them so they don't pollute the filesystem
-                    subprocess.run(["rm", "-rf", opath.absolute()])
-        if prev_best_tree.compare(best_tree, unrooted=True)["norm_rf"] == 0:
+        trace.set_iteration(iter_num)
+        if pending is None:
+            center = best_tree
+            # neighbors that have been visited already are dropped here
+            with trace.phase("neighborhood"):
+                pending, skipped = unvisited_neighbors(best_tree, visited_keys, index)
+            n_skipped += skipped
+            if args.climb == "stochastic":
+                random.shuffle(pending)
+            pending = deque(pending)
+        prev_best_key = topology_key(center, index)
+        while pending:
+            key, neighbor = pending.popleft()
+            stepnum += 1
+            opath = Path(f"{args.output}/step_{stepnum}")
+            visited_keys.add(key)
+            with trace.phase("evaluate"):
+                result = evaluate(neighbor, opath)
+            # suboptimal results only ever lived in the scratch workspace,
+            # so there's nothing to clean up for them
+            if result["Path"] is not None and result["log likelihood"] > best_likelihood:
+                with trace.phase("keep"):
+                    evaluate.keep(result, opath)
+                best_likelihood = result["log likelihood"]
+                best_tree = result["tree"]
+                best_info = result
+                # first improvement: move now. The rest of the neighborhood
+                # was never evaluated, so it stays out of visited_keys
+                if args.climb != "best":
+                    pending.clear()
+            save_checkpoint()
+        pending = None
+        if topology_key(best_tree, index) == prev_best_key:
             print(f"{str(iter_num).zfill(ndigits)}:\tDid not find a better tree, stopping...")
             break
         print(f"{str(iter_num).zfill(ndigits)}:\t{best_likelihood}")
         iter_num += 1
+        save_checkpoint()
+    checkpoint.wait()
+    evaluate.close()
 
-    # cleanup
+    # cleanup. With no tree scored (every run failed or timed out) there's no Path to keep
     for p in args.output.iterdir():
-        if not best_info["Path"].is_relative_to(p):
-            subprocess.run(["rm", "-rf", p.absolute()])
-    print(f"best result: {result['tree'].write(format=9)}")
+        if p.name.startswith("archive_"):
+            continue
+        if best_info["Path"] is None or not best_info["Path"].is_relative_to(p):
+            remove_path(p)
+    print(f"evaluated {stepnum + 1} trees, skipped {n_skipped} previously visited trees")
+    if evaluate.cache is not None:
+        print(f"likelihood cache: {evaluate.cache.hits} hits, {evaluate.cache.misses} misses")
+    if evaluate.limits is not None:
+        print("baseml runs: {} timed out, {} retried, {} gave up".format(*evaluate.limits.counts()))
+    if best_info["Path"] is None:
+        print("no tree could be scored")
+        return None
+    print(f"best result: {best_info['tree'].write(format=9)}")
     return best_info["Path"]
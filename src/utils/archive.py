@@ -0,0 +1,108 @@
+import io
+import json
+import queue
+import threading
+import zlib
+from pathlib import Path
+
+from . import baseml
+
+# what gets kept from every run directory
+ARCHIVED_FILES = ("RESULT", "LOG", "tree")
+
+class RunArchive:
+    """
+    Appends finished baseml runs to <output>/archive_r<rank>.dat, one
+    zlib-compressed record per run, so every evaluated tree can be kept
+    without leaving thousands of small files around.
+
+    <output>/archive_r<rank>.idx has a line per record
+    (step, assignment, offset, length), so any run can be read back
+    without decompressing the rest (see ArchiveReader).
+
+    add() reads the run's files right away, since the directory is about
+    to be reused, and leaves compressing and writing to a background thread.
+    """
+    def __init__(self, output_path, rank=0):
+        output_path = Path(output_path)
+        output_path.mkdir(parents=True, exist_ok=True)
+        self.data_path = output_path / f"archive_r{rank}.dat"
+        self.index_path = output_path / f"archive_r{rank}.idx"
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    def add(self, step, assignment, run_path):
+        contents = {}
+        for name in ARCHIVED_FILES:
+            path = Path(run_path) / name
+            if path.is_file():
+                contents[name] = path.read_text()
+        self.queue.put((step, assignment, contents))
+
+    def _write(self):
+        # append mode, so a resumed search adds to the same archive
+        with open(self.data_path, 'ab') as data, open(self.index_path, 'a') as index:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                step, assignment, contents = item
+                record = zlib.compress(json.dumps(contents).encode())
+                offset = data.tell()
+                data.write(record)
+                data.flush()
+                # index line goes after the data, so every indexed record is complete
+                index.write(f"{step}\t{assignment}\t{offset}\t{len(record)}\n")
+                index.flush()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+class ArchiveReader:
+    """
+    Random access to one rank's archive. index_path is the .idx file, the
+    .dat next to it holds the records. If a step and assignment were
+    archived twice (a resumed search re-running a step), the last one wins.
+    """
+    def __init__(self, index_path):
+        index_path = Path(index_path)
+        self.data_path = index_path.with_suffix(".dat")
+        self.index = {}
+        with open(index_path, 'r') as fi:
+            for line in fi:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) != 4: # cut off by a kill
+                    continue
+                step, assignment, offset, length = fields
+                self.index[(step, int(assignment))] = (int(offset), int(length))
+
+    def keys(self):
+        return list(self.index)
+
+    def get(self, step, assignment):
+        # dict of file name -> text for one run
+        offset, length = self.index[(step, assignment)]
+        with open(self.data_path, 'rb') as fi:
+            fi.seek(offset)
+            return json.loads(zlib.decompress(fi.read(length)))
+
+    def results(self):
+        """
+        Yields (step, assignment, parse_baseml_result of the run's RESULT)
+        for every archived run, in the order they were archived
+        """
+        with open(self.data_path, 'rb') as fi:
+            for (step, assignment), (offset, length) in sorted(self.index.items(), key=lambda x : x[1][0]):
+                fi.seek(offset)
+                contents = json.loads(zlib.decompress(fi.read(length)))
+                if "RESULT" not in contents:
+                    continue
+                yield step, assignment, baseml.parse_baseml_result(io.StringIO(contents["RESULT"]))
+
+def read_archives(output_path):
+    # every rank's archive under output_path
+    for index_path in sorted(Path(output_path).glob("archive_r*.idx")):
+        yield from ArchiveReader(index_path).results()
@@ -11,50 +11,112 @@ def parse_sub_rates(line):
 def parse_base_freqs(line):
     return np.array([float(x) for x in line.split()[3:]])
 
-def parse_baseml_result(result_path):
-    lines = read_all_lines(result_path)
-    
-    line_matcher = re.compile(r'(Node)[\s]+\#[\s]*[\d]+[\s]+[\w]+[\s]*\(blength')
-    line_matcher = re.compile(r'(Node)[\s]+\#[\s]*[\d]+[\s]+[\w]+[\s]*\(blength')
-    node_parameter_lines = [l for l in find_lines(lines, line_matcher, condition=lambda rgx, line : rgx.match(line) is not None)]
-
-    if not node_parameter_lines:
-        return []
-    all_tree_parameters = []
+# the regex has to match at the start of the line, so anything that doesn't
+# start with "Node" can be skipped without running it
+NODE_LINE = re.compile(r'(Node)[\s]+\#[\s]*[\d]+[\s]+[\w]+[\s]*\(blength')
+
+def parse_lnL(line):
+    return float(line.split(':')[3].split()[0])
+
+def iter_baseml_result(result_path):
+    """
+    Reads a RESULT file once, top to bottom, and yields a record per tree
+    as soon as that tree's node blocks are done. Records keep the raw lines
+    (turn one into the usual dict with tree_parameters), so if all you
+    want is the likelihoods you don't pay for ete3 trees and numpy arrays,
+    and you can stop reading whenever you like.
+
+    result_path can also be an open file or anything else that iterates
+    over lines (the run archive hands in the decompressed text this way).
+    """
+    if isinstance(result_path, (str, Path)):
+        with open(verified_file_path(result_path), 'r') as fi:
+            yield from iter_baseml_lines(fi)
+    else:
+        yield from iter_baseml_lines(result_path)
+
+def iter_baseml_lines(lines):
+    # most recent lines with 'lnL' and ';' - the lnL and tree for the next node block
+    lnL_line = None
+    tree_line = None
+    record = None
+    node = None
+    node_offset = 0
     last_node_number = 0
-    
-    lnL_line = first_instance_before_line(lines, node_parameter_lines[0], 'lnL')
-    lnL = float(lines[lnL_line].split(':')[3].split()[0])
-
-    tree_line = first_instance_before_line(lines, node_parameter_lines[0], ';')
-    
-    tree_parameters = {
-        'tree' : ete3.Tree(lines[tree_line].strip()),
-        'log likelihood' : lnL
-    }
+    for line in lines:
+        if 'lnL' in line:
+            lnL_line = line
+        if ';' in line:
+            tree_line = line
+        if node is not None:
+            # rates are on the line after the Node line, frequencies 2 after that
+            node_offset += 1
+            if node_offset == 1:
+                node[2] = line
+            elif node_offset == 3:
+                node[3] = line
+                node = None
+        if line.startswith('Node') and NODE_LINE.match(line):
+            node_number = int(line.split("#")[1].strip().split()[0])
+            node_label = line.split()[1]
+            if node_label == '(blength':
+                node_label = None
+            if record is None or last_node_number > node_number:
+                if record is not None:
+                    yield record
+                record = {
+                    'tree line' : tree_line,
+                    'log likelihood' : parse_lnL(lnL_line),
+                    'nodes' : []
+                }
+            node = [node_label, node_number, None, None]
+            node_offset = 0
+            record['nodes'].append(node)
+            last_node_number = node_number
+    if record is not None:
+        yield record
 
-    for npl in node_parameter_lines:
-        line_nohash = lines[npl].split("#")[1].strip()
-        node_number = int(line_nohash.split()[0])
-        node_label = lines[npl].split()[1]
-        if node_label == '(blength':
-            node_label = None
-        substitution_rates = parse_sub_rates(lines[npl+1])
-        base_freqs = parse_base_freqs(lines[npl+3])
-        node_parameters = {
+def split_baseml_result(text):
+    """
+    Splits the RESULT of a run with several trees in the treefile into a
+    RESULT per tree, in treefile order. Each piece starts at its "TREE #"
+    line, with whatever came before the first tree copied in front.
+    """
+    header, *trees = re.split(r"^(?=TREE #)", text, flags=re.MULTILINE)
+    return [header + tree for tree in trees]
+
+def tree_parameters(record):
+    parameters = {
+        'tree' : ete3.Tree(record['tree line'].strip()),
+        'log likelihood' : record['log likelihood']
+    }
+    for node_label, node_number, rates_line, freqs_line in record['nodes']:
+        parameters[node_number] = {
             'node label' : node_label,
             'node #' : node_number,
-            'substitution rates' : substitution_rates,
-            'base frequencies' : base_freqs
+            'substitution rates' : parse_sub_rates(rates_line),
+            'base frequencies' : parse_base_freqs(freqs_line)
         }
-        if last_node_number > node_number:
-            all_tree_parameters.append(tree_parameters)
-            tree_line = first_instance_before_line(lines, npl, ';')
-            lnL_line = first_instance_before_line(lines, npl, 'lnL')
-            lnL = float(lines[lnL_line].split(':')[3].split()[0])
-            tree_parameters = {'tree' : ete3.Tree(lines[tree_line].strip()), 'log likelihood' : lnL}
-        tree_parameters[node_number] = node_parameters
-        last_node_number = node_number
-    all_tree_parameters.append(tree_parameters)
-    return all_tree_parameters
+    return parameters
+
+def parse_baseml_result(result_path):
+    return [tree_parameters(record) for record in iter_baseml_result(result_path)]
+
+def baseml_log_likelihoods(result_path):
+    for record in iter_baseml_result(result_path):
+        yield record['log likelihood']
 
+def best_baseml_result(result_path):
+    """
+    Same as picking the max out of parse_baseml_result, but only the
+    winning tree gets turned into an ete3 tree and arrays
+    """
+    best_record = None
+    best_log_likelihood = float('-inf')
+    for record in iter_baseml_result(result_path):
+        if record['log likelihood'] > best_log_likelihood:
+            best_log_likelihood = record['log likelihood']
+            best_record = record
+    if best_record is None:
+        return {'log likelihood' : float('-inf')}
+    return tree_parameters(best_record)
@@ -0,0 +1,100 @@
+import hashlib
+import pickle
+import sqlite3
+import threading
+import time
+
+def file_hash(file_path):
+    h = hashlib.sha256()
+    with open(file_path, 'rb') as fi:
+        for chunk in iter(lambda : fi.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def connect_shared(db_path, **kwargs):
+    """
+    SQLite connection for a file several MPI ranks use at once, possibly
+    from different nodes. That rules out WAL, which needs shared memory on
+    one machine, so this uses the rollback journal, where all the locking
+    is file locks. The filesystem has to support those (on NFS or Lustre
+    that can mean mounting with locking on); without them the file can
+    get corrupted.
+    """
+    db = sqlite3.connect(db_path, timeout=60, isolation_level=None, **kwargs)
+    db.execute("PRAGMA journal_mode=DELETE")
+    return db
+
+def text_hash(text):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+# puts between evictions, so the DELETE (a scan of the last_used index)
+# doesn't run on every insert
+EVICT_EVERY = 256
+
+class LikelihoodCache:
+    """
+    baseml results kept on disk, keyed by (alignment, control file,
+    labelled tree). The alignment is identified by the hash of its
+    contents, so moving it around doesn't invalidate anything, and the
+    control file by the hash of the text baseml actually ran with, so
+    runs with different settings (--warm_start, say) never share entries.
+
+    SQLite does the locking, so several MPI ranks can share one cache file
+    (see connect_shared for what that needs from the filesystem).
+    Every EVICT_EVERY puts, whatever is past max_entries rows gets dropped,
+    least recently used first, so the table can run a little over in
+    between.
+    """
+    def __init__(self, cache_path, seq_path, max_entries=100000):
+        self.max_entries = max_entries
+        self.alignment = file_hash(seq_path)
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+        # run_single_shift_baseml may call in from several threads
+        self.lock = threading.Lock()
+        self.db = connect_shared(cache_path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "alignment TEXT, template TEXT, tree TEXT, result BLOB, raw TEXT, last_used REAL, "
+            "PRIMARY KEY (alignment, template, tree))"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+
+    def get(self, control, tree_key):
+        """
+        Returns (parsed result, RESULT file contents), or None on a miss
+        """
+        key = (self.alignment, text_hash(control), tree_key)
+        with self.lock:
+            row = self.db.execute(
+                "SELECT result, raw FROM results WHERE alignment=? AND template=? AND tree=?", key
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.db.execute(
+                "UPDATE results SET last_used=? WHERE alignment=? AND template=? AND tree=?", (time.time(),) + key
+            )
+        return pickle.loads(row[0]), row[1]
+
+    def put(self, control, tree_key, result, raw):
+        blob = pickle.dumps(result)
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+                (self.alignment, text_hash(control), tree_key, blob, raw, time.time())
+            )
+            self.puts += 1
+            if self.puts % EVICT_EVERY:
+                return
+            self.db.execute(
+                "DELETE FROM results WHERE rowid IN "
+                "(SELECT rowid FROM results ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+
+    def close(self):
+        with self.lock:
+            self.db.close()
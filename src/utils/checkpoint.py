@@ -0,0 +1,44 @@
+import os
+import pickle
+import threading
+from pathlib import Path
+
+class Checkpointer:
+    """
+    Keeps the search state in <output>/checkpoint.pkl so a killed run can
+    pick up where it left off.
+
+    save() pickles the state right away (so the caller can keep changing
+    it) and writes it on a background thread, through a temporary file
+    and os.replace, so a kill halfway through a write still leaves the
+    previous checkpoint in place.
+    """
+    def __init__(self, output_path):
+        self.path = Path(f"{output_path}/checkpoint.pkl")
+        self.thread = None
+
+    def save(self, state):
+        data = pickle.dumps(state)
+        self.wait()
+        self.thread = threading.Thread(target=self._write, args=(data,))
+        self.thread.start()
+
+    def _write(self, data):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, 'wb') as fo:
+            fo.write(data)
+            fo.flush()
+            os.fsync(fo.fileno())
+        os.replace(tmp_path, self.path)
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def load(self):
+        if not self.path.is_file():
+            return None
+        with open(self.path, 'rb') as fi:
+            return pickle.load(fi)
@@ -0,0 +1,129 @@
+import numpy as np
+import ete3
+
+# one-hot order for the nucleotide models, anything else (gaps, N, ...) is ignored
+NUCLEOTIDES = b"ACGT"
+TRANSITIONS = [(0, 2), (2, 0), (1, 3), (3, 1)] # A<->G, C<->T
+
+def encode_alignment(alignment):
+    """
+    Names and an (n taxa x n sites) uint8 array of the raw characters, built
+    once so every distance below works on arrays instead of strings
+    """
+    names = [record.id for record in alignment]
+    codes = np.array([np.frombuffer(str(record.seq).upper().encode('ascii'), dtype=np.uint8) for record in alignment])
+    return names, codes
+
+def identity_distances(codes, block_size=64):
+    # fraction of positions that differ, gaps and all (same as Biopython's 'identity')
+    n, n_sites = codes.shape
+    same = np.empty((n, n))
+    for start in range(0, n, block_size):
+        block = codes[start:start+block_size]
+        same[start:start+block_size] = (block[:, None, :] == codes[None, :, :]).sum(axis=2)
+    return 1 - same / n_sites
+
+def nucleotide_distances(codes, model='p'):
+    """
+    Pairwise p, JC69 ('jc') or K2P ('k2p') distances, counting only sites
+    where both sequences have an unambiguous base. Pair counts come from
+    one-hot matrix products, so there are no Python loops over taxa.
+    Saturated pairs get a large finite distance instead of inf/nan.
+    """
+    onehot = [(codes == base).astype(np.float64) for base in NUCLEOTIDES]
+    valid = sum(onehot)
+    n_valid = np.maximum(valid @ valid.T, 1)
+    same = sum(x @ x.T for x in onehot)
+    p = 1 - same / n_valid
+    if model == 'p':
+        distances = p
+    elif model == 'jc':
+        distances = -0.75 * np.log(np.maximum(1 - 4 * p / 3, 1e-6))
+    elif model == 'k2p':
+        transitions = sum(onehot[a] @ onehot[b].T for a, b in TRANSITIONS) / n_valid
+        transversions = p - transitions
+        distances = (
+            -0.5 * np.log(np.maximum(1 - 2 * transitions - transversions, 1e-6))
+            - 0.25 * np.log(np.maximum(1 - 2 * transversions, 1e-6))
+        )
+    else:
+        raise NotImplementedError(f"{model} distance not implemented")
+    np.fill_diagonal(distances, 0)
+    return distances
+
+def distance_matrix(alignment, model='identity'):
+    names, codes = encode_alignment(alignment)
+    if model == 'identity':
+        return names, identity_distances(codes)
+    return names, nucleotide_distances(codes, model)
+
+def remove_index(D, nodes, j, m):
+    # drop row/column j from the active m x m corner by moving the last one into it
+    D[j, :m] = D[m-1, :m]
+    D[:m, j] = D[:m, m-1]
+    nodes[j] = nodes[m-1]
+
+def neighbor_joining(names, distances):
+    """
+    Unrooted NJ tree (trifurcating root) from a distance matrix. Each join
+    is a handful of O(n^2) array ops, O(n^3) overall.
+    """
+    D = np.array(distances, dtype=np.float64)
+    nodes = [ete3.Tree(name=name) for name in names]
+    m = len(nodes)
+    while m > 3:
+        active = D[:m, :m]
+        r = active.sum(axis=1)
+        Q = (m - 2) * active - r[:, None] - r[None, :]
+        np.fill_diagonal(Q, np.inf)
+        i, j = sorted(np.unravel_index(np.argmin(Q), Q.shape))
+        dist_i = 0.5 * active[i, j] + (r[i] - r[j]) / (2 * (m - 2))
+        dist_j = active[i, j] - dist_i
+        parent = ete3.Tree()
+        parent.add_child(nodes[i], dist=max(dist_i, 0))
+        parent.add_child(nodes[j], dist=max(dist_j, 0))
+        new_row = 0.5 * (active[i] + active[j] - active[i, j])
+        new_row[i] = 0
+        D[i, :m] = new_row
+        D[:m, i] = new_row
+        nodes[i] = parent
+        remove_index(D, nodes, j, m)
+        m -= 1
+    root = ete3.Tree()
+    if m == 3:
+        for a, b, c in [(0, 1, 2), (1, 0, 2), (2, 0, 1)]:
+            root.add_child(nodes[a], dist=max(0.5 * (D[a, b] + D[a, c] - D[b, c]), 0))
+    else: # fewer than 3 taxa to begin with
+        for a in range(m):
+            root.add_child(nodes[a], dist=D[0, m-1] / 2)
+    return root
+
+def upgma(names, distances):
+    """
+    Rooted UPGMA tree from a distance matrix, O(n^3) with array ops
+    """
+    D = np.array(distances, dtype=np.float64)
+    nodes = [ete3.Tree(name=name) for name in names]
+    sizes = [1] * len(nodes)
+    heights = [0.0] * len(nodes)
+    m = len(nodes)
+    while m > 1:
+        active = D[:m, :m].copy()
+        np.fill_diagonal(active, np.inf)
+        i, j = sorted(np.unravel_index(np.argmin(active), active.shape))
+        height = D[i, j] / 2
+        parent = ete3.Tree()
+        parent.add_child(nodes[i], dist=max(height - heights[i], 0))
+        parent.add_child(nodes[j], dist=max(height - heights[j], 0))
+        new_row = (sizes[i] * D[i, :m] + sizes[j] * D[j, :m]) / (sizes[i] + sizes[j])
+        new_row[i] = 0
+        D[i, :m] = new_row
+        D[:m, i] = new_row
+        nodes[i] = parent
+        sizes[i] += sizes[j]
+        heights[i] = height
+        remove_index(D, nodes, j, m)
+        sizes[j] = sizes[m-1]
+        heights[j] = heights[m-1]
+        m -= 1
+    return nodes[0]
@@ -0,0 +1,34 @@
+from .cache import connect_shared
+
+class SharedCenters:
+    """
+    Which search got to each tree first, for multi-start runs (--starts).
+    A search's director claims every tree it moves to. From the same
+    center, a best-improvement search takes the same steps, so a search
+    that moves to a tree another search already moved to would only
+    retrace that search's path (with every likelihood coming out of the
+    shared cache) and can stop.
+
+    Lives in SQLite like LikelihoodCache (see connect_shared), so it works
+    across any number of ranks and sub-communicators without extra messages.
+    """
+    def __init__(self, db_path, search):
+        self.search = search
+        self.db = connect_shared(db_path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS centers ("
+            "tree TEXT PRIMARY KEY, search INTEGER, log_likelihood REAL)"
+        )
+
+    def claim(self, tree_key, log_likelihood):
+        """
+        Returns None if this search is the first to move to tree_key,
+        otherwise the search that was
+        """
+        key = repr(tree_key)
+        self.db.execute("INSERT OR IGNORE INTO centers VALUES (?, ?, ?)", (key, self.search, log_likelihood))
+        owner, = self.db.execute("SELECT search FROM centers WHERE tree=?", (key,)).fetchone()
+        return None if owner == self.search else owner
+
+    def close(self):
+        self.db.close()
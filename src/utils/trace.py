@@ -0,0 +1,114 @@
+import json
+import threading
+import time
+
+class _Off:
+    # what phase() hands back when tracing is off, so `with phase(...)` costs
+    # a method call and nothing else
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+OFF = _Off()
+
+class _Phase:
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.wall = time.time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.record(self.name, self.wall, time.perf_counter() - self.start)
+        return False
+
+class Tracer:
+    """
+    Per-phase counters and timings, per iteration, for one rank. Off by
+    default. With keep_events on, every phase is also kept as a Chrome
+    trace event (open the written file in chrome://tracing or Perfetto).
+    """
+    def __init__(self):
+        self.enabled = False
+        self.keep_events = False
+        self.rank = 0
+        self.iteration = None
+        self.totals = {}
+        self.events = []
+        self.lock = threading.Lock()
+
+    def configure(self, enabled, keep_events=False, rank=0):
+        self.enabled = enabled or keep_events
+        self.keep_events = keep_events
+        self.rank = rank
+
+    def phase(self, name):
+        if not self.enabled:
+            return OFF
+        return _Phase(self, name)
+
+    def set_iteration(self, iteration):
+        self.iteration = iteration
+
+    def record(self, name, wall, seconds):
+        with self.lock:
+            counter = self.totals.setdefault((self.iteration, name), [0, 0.0])
+            counter[0] += 1
+            counter[1] += seconds
+            if self.keep_events:
+                self.events.append({
+                    "name" : name,
+                    "ph" : "X",
+                    "ts" : wall * 1e6,
+                    "dur" : seconds * 1e6,
+                    "pid" : self.rank,
+                    "tid" : threading.get_ident() % 100000,
+                    "args" : {"iteration" : self.iteration}
+                })
+
+    def state(self):
+        # plain data, for sending to rank 0
+        return {"rank" : self.rank, "totals" : self.totals, "events" : self.events}
+
+tracer = Tracer()
+phase = tracer.phase
+set_iteration = tracer.set_iteration
+
+def summary(states):
+    """
+    Table of count / total / mean per phase for every rank in states
+    (a list of Tracer.state()), then total seconds per phase per iteration
+    """
+    lines = [f"{'rank':>4} {'phase':<14} {'count':>7} {'total s':>10} {'mean ms':>10}"]
+    per_iteration = {}
+    for state in states:
+        by_phase = {}
+        for (iteration, name), (count, seconds) in state["totals"].items():
+            counter = by_phase.setdefault(name, [0, 0.0])
+            counter[0] += count
+            counter[1] += seconds
+            iteration_totals = per_iteration.setdefault(iteration, {})
+            iteration_totals[name] = iteration_totals.get(name, 0.0) + seconds
+        for name, (count, seconds) in sorted(by_phase.items(), key=lambda x : -x[1][1]):
+            lines.append(f"{state['rank']:>4} {name:<14} {count:>7} {seconds:>10.3f} {1000 * seconds / count:>10.2f}")
+    for iteration in sorted(per_iteration, key=lambda x : -1 if x is None else x):
+        phases = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in sorted(per_iteration[iteration].items()))
+        lines.append(f"iteration {'-' if iteration is None else iteration}: {phases}")
+    return "\n".join(lines)
+
+def write_chrome_trace(path, states):
+    events = []
+    other = {}
+    for state in states:
+        events.extend(state["events"])
+        other[f"rank {state['rank']}"] = [
+            {"iteration" : iteration, "phase" : name, "count" : count, "seconds" : seconds}
+            for (iteration, name), (count, seconds) in state["totals"].items()
+        ]
+    with open(path, 'w') as fo:
+        json.dump({"traceEvents" : events, "displayTimeUnit" : "ms", "otherData" : other}, fo)
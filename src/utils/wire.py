@@ -0,0 +1,79 @@
+import ete3
+import numpy as np
+from mpi4py import MPI
+
+# What goes over MPI every iteration of strategy 1, as flat buffers instead
+# of pickles: trees go out as newick strings packed into one byte buffer
+# (Scatterv), and only the local best log likelihoods come back (Gather).
+# The full result, with its ete3 tree and per-node arrays, is only sent by
+# the rank that won (fetch_winner).
+
+STOP = -1
+
+def encode_trees(trees, fmt):
+    # every newick ends in ';', so they can just be concatenated
+    return "".join(tree.write(format=fmt) for tree in trees).encode()
+
+def decode_trees(buf):
+    return [ete3.Tree(newick + ";", format=1) for newick in buf.tobytes().decode().split(";")[:-1]]
+
+def scatter_trees(comm, partition, fmt):
+    """
+    Root side: sends partition[i] (a list of trees) to rank i and returns
+    its own share. partition=None tells everyone to stop.
+    """
+    comm_size = comm.Get_size()
+    if partition is None:
+        counts = np.full(comm_size, STOP, dtype=np.int64)
+        comm.Scatter(counts, np.empty(1, dtype=np.int64), root=0)
+        return None
+    encoded = [encode_trees(trees, fmt) for trees in partition]
+    counts = np.array([len(buf) for buf in encoded], dtype=np.int64)
+    comm.Scatter(counts, np.empty(1, dtype=np.int64), root=0)
+    sendbuf = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    displacements = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    recvbuf = np.empty(counts[0], dtype=np.uint8)
+    comm.Scatterv([sendbuf, counts, displacements, MPI.BYTE], recvbuf, root=0)
+    return decode_trees(recvbuf)
+
+def receive_trees(comm):
+    """
+    Worker side of scatter_trees. Returns None when told to stop.
+    """
+    count = np.empty(1, dtype=np.int64)
+    comm.Scatter(None, count, root=0)
+    if count[0] == STOP:
+        return None
+    recvbuf = np.empty(count[0], dtype=np.uint8)
+    comm.Scatterv(None, recvbuf, root=0)
+    return decode_trees(recvbuf)
+
+def gather_likelihoods(comm, log_likelihood):
+    """
+    Every rank's best log likelihood (-inf for nothing yet), as an array
+    on the root and None elsewhere
+    """
+    sendbuf = np.array([log_likelihood], dtype=np.float64)
+    recvbuf = np.empty(comm.Get_size(), dtype=np.float64) if comm.Get_rank() == 0 else None
+    comm.Gather(sendbuf, recvbuf, root=0)
+    return recvbuf
+
+def fetch_winner(comm, winner, result):
+    """
+    Collective. The root passes the rank whose result it wants (or STOP
+    for none), everyone else passes anything. The winner's result is
+    returned on the root, and None everywhere else.
+    """
+    rank = comm.Get_rank()
+    buf = np.array([winner if rank == 0 else 0], dtype=np.int64)
+    comm.Bcast(buf, root=0)
+    winner = int(buf[0])
+    if winner == STOP:
+        return None
+    if winner == 0:
+        return result if rank == 0 else None
+    if rank == winner:
+        comm.send(result, dest=0)
+    elif rank == 0:
+        return comm.recv(source=winner)
+    return None
@@ -0,0 +1,58 @@
+import atexit
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+def default_scratch_root():
+    shm = Path("/dev/shm")
+    if shm.is_dir() and os.access(shm, os.W_OK):
+        return shm
+    return Path(tempfile.gettempdir())
+
+def remove_path(path):
+    # in-process rm -rf
+    if path.is_dir() and not path.is_symlink():
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        path.unlink(missing_ok=True)
+
+class Workspace:
+    """
+    Per-process scratch space for baseml runs, on node-local storage
+    (/dev/shm when there is one) instead of the output directory.
+
+    Runs happen in a fixed set of named slots that get emptied and reused,
+    so a search doesn't keep creating and deleting directories on the
+    shared filesystem. Only results handed to keep() get copied to the
+    output directory. The whole thing is removed by close() (or at exit).
+    """
+    def __init__(self, root=None):
+        root = Path(root) if root else default_scratch_root()
+        self.path = Path(tempfile.mkdtemp(prefix=f"nhts-{os.getpid()}-", dir=root))
+        atexit.register(self.close)
+
+    def slot(self, name):
+        path = self.path / name
+        if path.is_dir():
+            for p in path.iterdir():
+                remove_path(p)
+        else:
+            path.mkdir()
+        return path
+
+    def keep(self, result, output_path):
+        """
+        Copies the run in result["Path"] to output_path (under the same
+        name) and points result["Path"] at the copy
+        """
+        dest = Path(output_path) / result["Path"].name
+        if dest.exists():
+            remove_path(dest)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copytree(result["Path"], dest)
+        result["Path"] = dest
+        return result
+
+    def close(self):
+        shutil.rmtree(self.path, ignore_errors=True)